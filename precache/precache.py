@@ -17,8 +17,10 @@ your fix.
 from __future__ import print_function
 
 import argparse
+import binascii
 import collections
 import hashlib
+import httplib
 import logging
 import logging.handlers
 import os
@@ -27,19 +29,32 @@ import re
 import socket
 import subprocess
 import sys
+import threading
 import urllib2
 import base64
 
-from operator import attrgetter
-from itertools import groupby
-from random import uniform
-from time import sleep
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
 from Foundation import NSBundle
 from WebKit import WKWebView
 import pprint
 
+from prelib import catalog
+from prelib import feedcache
+from prelib import fleet
+from prelib import ipswindex
+from prelib import internet
+from prelib import manifest
+from prelib import metacache
+from prelib import partial
+from prelib import plistream
+from prelib import probe
+from prelib import ratelimit
+from prelib import scheduler
+from prelib import snapshot
+from prelib import verify
+
 # Version
 version = '1.1.2'
 
@@ -48,6 +63,40 @@ def print_version():
     print('precache.py version %s' % (version))
 
 
+# Hash every file in an IPSW store folder and report any that do not match
+# their published digest. Returns the number of files that failed.
+def verify_store(folder, algorithm='sha1', workers=4):
+    folder = os.path.expanduser(folder)
+    if not os.path.isdir(folder):
+        print('%s is not a folder' % (folder))
+        return 1
+
+    def report(result):
+        if result.actual is None:
+            print('UNREADABLE: %s' % (result.filename))
+        elif result.expected is None:
+            print('NO DIGEST:  %s %s' % (result.filename, result.actual))
+        elif result.expected == result.actual:
+            print('OK:         %s' % (result.filename))
+        else:
+            print('MISMATCH:   %s expected %s, got %s' % (
+                result.filename, result.expected, result.actual))
+
+    verifier = verify.StoreVerifier(folder, algorithm=algorithm,
+                                    workers=workers)
+    results, seconds = verifier.run(callback=report)
+    total = sum(result.size for result in results)
+    failed = [result for result in results
+              if result.actual is None or
+              (result.expected and result.expected != result.actual)]
+    print('Checked %d files (%.2fGB) with %s in %.1fs, %.1fMB/s: '
+          '%d failed, %d without a digest' % (
+              len(results), total / 1024.0 ** 3, algorithm, seconds,
+              total / 1024.0 ** 2 / max(seconds, 0.001), len(failed),
+              sum(1 for result in results if result.expected is None)))
+    return len(failed)
+
+
 class PreCache(object):
     '''
     Contains a number of default settings and other such configuration
@@ -58,8 +107,9 @@ class PreCache(object):
     from a single source, so from time to time, the Caching Server or Apple
     sends back a HTTP 503 response when attempting to retrieve assets.
     To try and mitigate this, user agent strings are set as best as possible to
-    match what Apple software sends out, and a random sleep period between 1
-    and 5 seconds is used for each download request.
+    match what Apple software sends out, and requests to each host are rate
+    limited. The limit only tightens when a host answers 503 or 429 (honouring
+    any Retry-After), and relaxes again after a run of successful requests.
 
     Logs are stored in '/tmp/precache.log'. Beta items are not cached by
     default. This can be changed, but the results haven't been tested.
@@ -69,11 +119,38 @@ class PreCache(object):
     wish to download many things, then use the special flags that are designed
     to cache particular groups of assets (i.e. --cache-group updates).
 
-    At the moment, there isn't a satisfactory way to avoid downloading and
-    parsing the software updates feed, this adds additional time to processing.
+    Feeds are fetched and parsed concurrently on a pool of 'feed_workers'
+    threads, then merged in a fixed order. Feed bodies are kept in
+    'cache_dir' and only downloaded again when the server reports they have
+    changed. With lazy=True no feed is loaded up front; each one is loaded
+    the first time a model or group that it can contain is asked for, so a
+    narrow run never waits on the software updates feed.
+
+    What each feed contributed is kept in a snapshot, which is used instead
+    of the feed for 'snapshot_ttl' seconds. With offline=True the snapshot is
+    used whatever its age and no feed is ever fetched.
+
+    Before anything is downloaded, the caching server is asked for the first
+    byte of each asset. Assets it already holds are skipped, so only the ones
+    it does not have are transferred in full.
+
+    'model_weights' maps a model to the number of devices that use it, such
+    as the counts from Jamf. Downloads are then run in order of the devices
+    they serve, most first, so a run that is cut short has still fetched
+    the assets most devices will ask for.
+
+    'fleet_builds' maps a model to the OS builds its devices run. When it is
+    given, delta OTAs for a model are only cached if they install over one
+    of those builds; full OTAs are always cached.
     '''
     def __init__(self, cache_server=None, cache_beta=False, dry_run=True,
-                 log_level='info', ver=version):
+                 log_level='info', ver=version, feed_workers=4,
+                 cache_dir=None, probe_workers=8, negative_ttl=86400,
+                 lazy=False, snapshot_ttl=3600, offline=False,
+                 download_workers=4, per_host=2, max_retries=3, proxy=None,
+                 chunk_size=1048576, segments=1,
+                 ipsw_index_ttl=ipswindex.IPSW_INDEX_TTL,
+                 model_weights=None, fleet_builds=None):
 
         # Handle logging
         self.log = logging.getLogger('precache')
@@ -122,10 +199,68 @@ class PreCache(object):
         self.mas_base_url = 'http://osxapps.itunes.apple.com'
 
         # Remote plist feed of MAS apps that can be cached
-        self.mas_plist = urllib2.urlopen('https://raw.githubusercontent.com/primalcurve/precache/master/com.github.krypted.precache.apps-list.plist')  # NOQA
-        self.mas_plist = self.mas_plist.read()
-
-        self.mas_assets = plistlib.readPlistFromString(self.mas_plist)
+        self.mas_plist_url = 'https://raw.githubusercontent.com/primalcurve/precache/master/com.github.krypted.precache.apps-list.plist'  # NOQA
+        self.mas_assets = {}
+
+        # Listing of every device's firmwares on ipsw.me, refreshed at most
+        # once per ipsw_index_ttl seconds
+        self.ipsw_index_url = ipswindex.IPSW_INDEX_URL
+        self.ipsw_index_ttl = ipsw_index_ttl
+        self.ipsw_index = None
+        # Held while the listing is loaded, so it is only fetched once
+        self.ipsw_index_lock = threading.Lock()
+
+        # Number of feeds fetched and parsed at the same time
+        self.feed_workers = feed_workers
+
+        # Shared keep-alive HTTP client, used for every request so that
+        # connections to each host are reused
+        if proxy:
+            internet.configure_client(proxy=proxy)
+        self.http = internet.client()
+
+        # Persistent cache for feeds, revalidated on each run
+        self.cache_dir = self.expand_path(
+            cache_dir or '~/Library/Caches/com.github.krypted.precache')
+        self.feed_cache = feedcache.FeedCache(
+            os.path.join(self.cache_dir, 'feeds'), opener=self.http)
+
+        # Downloads run at the same time, in total and per origin host
+        self.download_workers = download_workers
+        self.per_host = per_host
+        self.chunk_size = chunk_size
+        # Byte ranges a large kept file is fetched in at once
+        self.segments = segments
+        self.output_lock = threading.RLock()
+        self.manifests = {}
+        # Devices per model, used to order the downloads
+        self.model_weights = model_weights or {}
+        # OS builds per model in the fleet, used to drop unneeded delta OTAs
+        self.fleet_builds = fleet_builds
+
+        # Per host rate limiting, tightened only when a server pushes back
+        self.limiter = ratelimit.HostLimiter()
+        self.max_retries = max_retries
+        self.http_timeout = 60
+
+        # Snapshot of the feed entries from previous runs
+        self.offline = offline
+        self.snapshot = snapshot.CatalogSnapshot(
+            os.path.join(self.cache_dir, 'catalog.snapshot'),
+            ttl=snapshot_ttl)
+
+        # Concurrent HEAD/SMD lookups for software update packages, with the
+        # results kept between runs. Missing packages are looked up again
+        # after negative_ttl seconds.
+        self.metadata_cache = metacache.MetadataCache(
+            os.path.join(self.cache_dir, 'metadata.json'),
+            negative_ttl=negative_ttl)
+        self.cache_status = {}
+        self.prober = probe.Prober(
+            workers=probe_workers,
+            headers={'User-Agent': 'precache/%s' % (self.version)},
+            opener=self.http, cache=self.metadata_cache,
+            limiter=self.limiter, max_retries=self.max_retries)
 
         # User agent strings
         self.user_agents = {
@@ -148,17 +283,18 @@ class PreCache(object):
         else:
             self.find_cache_server()
 
-        # Test the server is real
-        s = socket.socket()
-        address = urlparse(self.cache_server).netloc.split(':')[0]
-        port = int(urlparse(self.cache_server).netloc.split(':')[1])
+        # Test the server is real, unless only planning from the snapshot
+        if not offline:
+            s = socket.socket()
+            address = urlparse(self.cache_server).netloc.split(':')[0]
+            port = int(urlparse(self.cache_server).netloc.split(':')[1])
 
-        try:
-            s.connect((address, port))
-        except Exception as e:
-            print('%s - Check %s is a valid address' % (e,
-                                                        self.cache_server))
-            sys.exit(1)
+            try:
+                s.connect((address, port))
+            except Exception as e:
+                print('%s - Check %s is a valid address' % (
+                    e, self.cache_server))
+                sys.exit(1)
 
         # Named tuple for asset creation to drop into self.assets_master
         self.Asset = collections.namedtuple('Asset', ['model',
@@ -166,17 +302,29 @@ class PreCache(object):
                                                       'url',
                                                       'group'])
 
-        # iOS and App Store Master asset list
-        self.assets_master = []
+        # iOS and App Store Master asset catalog
+        self.assets_master = catalog.AssetCatalog()
 
-        # IPSW master asset list
-        self.ipsw_assets_master = []
+        # IPSW master asset catalog
+        self.ipsw_assets_master = catalog.AssetCatalog()
 
-        # IPSW models master list
-        self.ipsw_models_master = []
+        # Feeds that have been merged into the master lists so far
+        self.loaded_sources = []
+        # Feeds whose entries depend on lookups that failed this run
+        self.unsettled_sources = set()
+
+        print('precache version %s' % (self.version))
+        print('Caching Server: %s' % (self.cache_server))
 
         # Build assets
-        self.build_asset_master_list()
+        if not lazy:
+            self.build_asset_master_list()
+
+    # Every device model seen in the OTA feeds is an IPSW candidate
+    @property
+    def ipsw_models_master(self):
+        return self.assets_master.models(
+            exclude=('app', 'installer', 'updates'))
 
     # Graceful exit
     def gext(self):
@@ -256,24 +404,61 @@ class PreCache(object):
                     'Fallback Caching Server %s' % (self.cache_server)
                 )
 
-    # Wrapper around urllib2 request that does some error checking
-    def url_request(self, url, user_agent=None):
-        try:
-            if not user_agent:
-                ua_string = 'precache/%s' % (self.version)
+    # Wrapper around urllib2 request that does some error checking. Requests
+    # go through the shared keep-alive client, are rate limited per host, and
+    # are retried after a 503 or 429.
+    def url_request(self, url, user_agent=None, cached=False, headers=None,
+                    max_age=None):
+        host = scheduler.host_key(url)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(host)
+            try:
+                if not user_agent:
+                    ua_string = 'precache/%s' % (self.version)
+                else:
+                    ua_string = user_agent
+
+                self.log.debug('User agent: %s' % (ua_string))
+                if cached:
+                    # Conditional GET against the feed cache
+                    req = self.feed_cache.open(
+                        url, headers={'User-Agent': ua_string},
+                        max_age=max_age)
+                else:
+                    request = urllib2.Request(url)
+                    request.add_unredirected_header('User-Agent', ua_string)
+                    for key, value in (headers or {}).items():
+                        request.add_header(key, value)
+                    req = self.http.open(request, timeout=self.http_timeout)
+            except urllib2.HTTPError as e:
+                if e.code in (429, 503) and attempt < self.max_retries:
+                    delay = self.limiter.backoff(
+                        host, e.info().getheader('Retry-After'))
+                    self.log.info('%s from %s, retrying in %0.1fs' % (
+                        e.code, host, delay))
+                    continue
+                self.log.debug('%s %s' % (e, url))
+                return None
+            except urllib2.URLError as e:
+                self.log.debug('%s %s' % (e, url))
+                return None
             else:
-                ua_string = user_agent
-
-            self.log.debug('User agent: %s' % (ua_string))
-            request = urllib2.Request(url)
-            request.add_unredirected_header('User-Agent', ua_string)
-            req = urllib2.urlopen(request)
-        except (urllib2.URLError, urllib2.HTTPError) as e:
-            self.log.debug('%s %s' % (e, url))
-            pass
-        else:
-            self.log.debug('Opened connection to %s' % (url))
-            return req
+                self.limiter.success(host)
+                self.log.debug('Opened connection to %s' % (url))
+                return req
+
+    # Fetch a feed through the feed cache and parse it, reusing the parsed
+    # result from the previous run if the feed has not changed. A copy
+    # younger than max_age seconds is used without asking the server.
+    def parse_feed(self, url, parse=plistlib.readPlist, max_age=None):
+        req = self.url_request(url, cached=True, max_age=max_age)
+        if req.from_cache:
+            self.log.info('Feed unchanged, using cached copy of %s' % (url))
+        # Parsed results are stored with the entry format, so a change to
+        # the shape of the entries parses an unchanged feed again
+        return self.feed_cache.parse(
+            req, parse, key='%s-%d' % (parse.__name__,
+                                       snapshot.SNAPSHOT_FORMAT))
 
     # Convert the URL to a format useable with the cache server
     def convert_url(self, url):
@@ -304,6 +489,11 @@ class PreCache(object):
         Note: There are a number of iOS 10 releases that start with 9.9 (i.e.
         9.9.10.1) - these are deliberately not added as a cacheable asset, this
         cuts down on the significant number of data downloaded for each asset.
+        Returns a list of (model, version, url, group, meta) entries to be
+        merged into the master list, or None if the feed could not be read, meta holding the sha1 of the update when
+        the feed lists one and the build a delta update installs over. An
+        update has an entry for each of its SupportedDevices, all sharing its
+        URL.
         '''
         def cacheable(item):
             if item.get('__CanUseLocalCacheServer'):
@@ -319,9 +509,8 @@ class PreCache(object):
             else:
                 return False
 
-        def supported_device(item):
-            if item.get('SupportedDevices'):
-                return item['SupportedDevices'][0]
+        def supported_devices(item):
+            return item.get('SupportedDevices') or []
 
         def get_asset_url(item):
             if item.get('RealUpdateAttributes'):
@@ -333,6 +522,16 @@ class PreCache(object):
             if item.get('OSVersion'):
                 return item['OSVersion']
 
+        def get_asset_meta(item):
+            # Full updates have no PrerequisiteBuild
+            meta = {'prerequisite': item.get('PrerequisiteBuild')}
+            # _Measurement is the raw SHA-1 of the update zip
+            measurement = item.get('_Measurement')
+            if (measurement is not None and
+                    item.get('_MeasurementAlgorithm', 'SHA-1') == 'SHA-1'):
+                meta['sha1'] = binascii.hexlify(measurement.data)
+            return meta
+
         def is_watch(item):
             if 'Watch' in item:
                 return True
@@ -351,52 +550,57 @@ class PreCache(object):
             elif 'iPod' in item:
                 return 'iPod'
 
+        def asset_entries(item):
+            if is_beta(item) or not supported_devices(item):
+                return []
+
+            url = get_asset_url(item)
+            os_ver = get_asset_version(item)
+            meta = get_asset_meta(item)
+            if not os_ver or len(os_ver.split('.')) >= 4:
+                return []
+
+            return [(model, os_ver, url, group_type(model), meta)
+                    for model in supported_devices(item)
+                    if is_watch(model) or cacheable(item)]
+
+        # Stream the feed, keeping only the entries that will be cached.
+        # They are only handed back once the whole feed has been read.
+        def ota_entries(req):
+            found = []
+            plistream.parse_stream(
+                req, ('Assets',),
+                lambda index, item: found.extend(asset_entries(item)))
+            return found
+
         try:
             self.log.info('Starting process work on %s' % (feed))
-            req = self.url_request(feed)
-            xml = plistlib.readPlistFromString(req.read())
-
-            for item in xml['Assets']:
-                if not is_beta(item):
-                    if supported_device(item):
-                        model = supported_device(item)
-
-                    if get_asset_url(item):
-                        url = get_asset_url(item)
+            return self.parse_feed(feed, ota_entries)
 
-                    if get_asset_version(item):
-                        os_ver = get_asset_version(item)
-
-                    group = group_type(model)
-
-                    if len(os_ver.split('.')) < 4:
-                        if is_watch(model):
-                            self.add_asset(model, os_ver, url, group)
-                        else:
-                            if cacheable(item):
-                                self.add_asset(model, os_ver, url, group)
-
-            [self.ipsw_models_master.append(item.model) for item in
-             self.assets_master if item.model not in self.ipsw_models_master]
-
-            req.close()
         except Exception as e:
+            # A feed that could not be read to the end adds nothing
             self.log.debug('%s - %s' % (e, feed))
-            pass
+            return None
 
-    # Build MAS assets
+    # Build MAS assets. None if the list could not be read.
     def build_mas_assets(self):
+        entries = []
         try:
+            self.mas_assets = self.parse_feed(self.mas_plist_url)
+
             for item in self.mas_assets:
                 model = item
                 version = self.mas_assets[item]['version']
                 url = self.mas_assets[item]['url']
                 group = self.mas_assets[item]['type']
-                self.add_asset(model, version, url, group)
+                entries.append((model, version, url, group))
         except Exception as e:
             self.log.debug('%s' % (e))
+            return None
 
-    # Build Software updates assets
+        return entries
+
+    # Build Software updates assets. None if the catalog could not be read.
     def build_su_assets(self):
         group_type = 'updates'
 
@@ -420,114 +624,229 @@ class PreCache(object):
             'macOSUpd': '10.12.0',
             'OSXUpd': '10.11.6',
         }
-        xml_req = self.url_request(self.osx_catalog_xml)
-        updates = plistlib.readPlistFromString(xml_req.read())
-        products = updates['Products']
-
-        for item in products:
-            packages = updates['Products'][item]['Packages']
-            for pkg in packages:
-                # pprint.pprint(pkg)
-                pkg_url = pkg['URL']
-                # pprint.pprint(pkg_url)
-                base_url = os.path.splitext(pkg_url)[0]
-                # pprint.pprint(base_url)
-                smd_url = '%s.smd' % base_url
-                # pprint.pprint(smd_url)
-                basename = os.path.basename(os.path.splitext(pkg_url)[0])
-                # pprint.pprint(basename)
-                for upd in cacheable_updates:
-                    if upd in basename and not beta_preview(basename):
-                        req = self.url_request(smd_url)
-                        if req:
-                            smd_info = plistlib.readPlistFromString(
-                                req.read()
-                            )
-                            version = (
-                                smd_info['CFBundleShortVersionString']
-                            )
-                            if re.search('[a-zA-Z]', version):
-                                version = (
-                                    re.findall(r'[\d.]+', basename)
-                                )
-                            req.close()
-                        else:
-                            version = re.findall(r'[\d.]+', basename)
 
-                        try:
-                            if version.endswith('.'):
-                                version = version[:-1]
-                        except:
-                            pass
+        # Only the packages of cacheable updates are kept out of the catalog,
+        # which is streamed one product at a time.
+        def candidate_packages(req):
+            candidates = []
 
-                        try:
-                            if (
-                                get_version(upd, version,
-                                            cacheable_updates[upd])
-                            ):
-                                if 'macOSUpd' in basename:
-                                    firmware_name = (
-                                        '%s-Firmware' % basename
-                                    )
-                                    firmware_url = (
-                                        os.path.join(
-                                            base_url.replace(basename, ''),
-                                            'FirmwareUpdate.pkg'
-                                        )
-                                    )
-                                    req = self.url_request(firmware_url)
-
-                                    full_bundle_name = (
-                                        '%s-FullBundle' % basename
-                                    )
-                                    full_bundle_url = (
-                                        os.path.join(
-                                            base_url.replace(basename, ''),
-                                            'FullBundleUpdate.pkg'
-                                        )
-                                    )
-                                    req = self.url_request(firmware_url)
-                                    if req:
-                                        self.add_asset(firmware_name,
-                                                       version,
-                                                       firmware_url,
-                                                       group_type)
-                                        req.close()
-
-                                    req = self.url_request(full_bundle_url)
-                                    if req:
-                                        self.add_asset(full_bundle_name,
-                                                       version,
-                                                       full_bundle_url,
-                                                       group_type)
-                                        req.close()
-
-                                    self.add_asset(basename, version, pkg_url,
-                                                   group_type)
-                                else:
-                                    self.add_asset(basename, version,
-                                                   pkg_url, group_type)
-                        except:
-                            pass
-        xml_req.close()
+            def product_entry(product_key, product):
+                for pkg in product.get('Packages', []):
+                    pkg_url = pkg['URL']
+                    basename = os.path.basename(os.path.splitext(pkg_url)[0])
+                    for upd in cacheable_updates:
+                        if upd in basename and not beta_preview(basename):
+                            candidates.append((upd, pkg_url))
+
+            plistream.parse_stream(req, ('Products',), product_entry)
+            return candidates
 
-    # Build the asset master list:
-    def build_asset_master_list(self):
         try:
-            print('precache version %s' % (self.version))
-            print('Caching Server: %s' % (self.cache_server))
-            print('Processing feeds. This may take a few moments.')
-            [self.process_ios_feed(self.ios_update_feeds[feed])
-             for feed in self.ios_update_feeds]
-
-            self.build_mas_assets()
-            self.build_su_assets()
+            candidates = self.parse_feed(self.osx_catalog_xml,
+                                         candidate_packages)
+        except Exception as e:
+            self.log.debug('%s - %s' % (e, self.osx_catalog_xml))
+            return None
+
+        # Look up every SMD and check for firmware and full bundle packages in
+        # one concurrent batch rather than one request at a time.
+        def package_urls(pkg_url):
+            base_url = os.path.splitext(pkg_url)[0]
+            basename = os.path.basename(base_url)
+            folder = base_url.replace(basename, '')
+            return (basename, '%s.smd' % base_url,
+                    os.path.join(folder, 'FirmwareUpdate.pkg'),
+                    os.path.join(folder, 'FullBundleUpdate.pkg'))
+
+        targets = []
+        for upd, pkg_url in candidates:
+            basename, smd_url, firmware_url, full_bundle_url = (
+                package_urls(pkg_url))
+            targets.append((smd_url, 'smd'))
+            if 'macOSUpd' in basename:
+                targets.append((firmware_url, 'head'))
+                targets.append((full_bundle_url, 'head'))
+        probes = self.prober.probe(targets)
+        # Packages that could not be checked are left out for now, but this
+        # result must not be kept in the snapshot
+        unknown = [x for x in probes.values() if x.status is None]
+        if unknown:
+            self.log.info('%s software update lookups failed, not keeping '
+                          'a snapshot of them' % (len(unknown)))
+            self.unsettled_sources.add('updates')
+
+        entries = []
+        for upd, pkg_url in candidates:
+            basename, smd_url, firmware_url, full_bundle_url = (
+                package_urls(pkg_url))
+            version = probe.smd_version(probes.get(smd_url), basename)
+
+            try:
+                if get_version(upd, version, cacheable_updates[upd]):
+                    if 'macOSUpd' in basename:
+                        if probes[firmware_url].exists:
+                            entries.append(('%s-Firmware' % basename,
+                                            version,
+                                            firmware_url,
+                                            group_type))
+
+                        if probes[full_bundle_url].exists:
+                            entries.append(('%s-FullBundle' % basename,
+                                            version,
+                                            full_bundle_url,
+                                            group_type))
+
+                    entries.append((basename, version, pkg_url, group_type))
+            except:
+                pass
+
+        return entries
+
+    # All feed sources, in the order they are merged
+    def all_sources(self):
+        return list(self.ios_update_feeds) + ['mas', 'updates']
+
+    # Work out which feeds can contain the given models and groups
+    def sources_for(self, model=None, group=None):
+        group_sources = {
+            'AppleTV': ['tv'],
+            'iPad': ['ios'],
+            'iPhone': ['ios'],
+            'iPod': ['ios'],
+            'Watch': ['watch'],
+            'app': ['mas'],
+            'installer': ['mas'],
+            'updates': ['updates'],
+        }
+        model_prefixes = [
+            ('iPhone', 'ios'),
+            ('iPad', 'ios'),
+            ('iPod', 'ios'),
+            ('AppleTV', 'tv'),
+            ('Watch', 'watch'),
+            ('macOSUpd', 'updates'),
+            ('OSXUpd', 'updates'),
+        ]
+
+        def model_sources(m):
+            for prefix, source in model_prefixes:
+                if m.startswith(prefix):
+                    return [source]
+            # Any other device identifier could be in any of the OTA feeds,
+            # anything else is an app or installer name.
+            if re.match(r'^[A-Za-z]+\d+,\d+$', m):
+                return list(self.ios_update_feeds)
+            return ['mas']
+
+        sources = set()
+        for g in group or []:
+            sources.update(group_sources.get(g, self.all_sources()))
+        for m in model or []:
+            sources.update(model_sources(m))
+        return [x for x in self.all_sources() if x in sources]
+
+    # Build the asset master list from the given sources, or all of them.
+    # Sources that are already loaded are skipped.
+    def build_asset_master_list(self, sources=None):
+        try:
+            if sources is None:
+                sources = self.all_sources()
+            sources = [x for x in sources if x not in self.loaded_sources]
+            if not sources:
+                return
+
+            # Sources still fresh in the snapshot (or any age when offline)
+            # are not fetched at all.
+            stored = dict((x, self.snapshot.entries(x, offline=self.offline))
+                          for x in sources)
+            fetch = [x for x in sources if stored[x] is None]
+            if self.offline and fetch:
+                print('Offline: no snapshot of %s, skipping' % (
+                    ', '.join(fetch)))
+                self.log.error('Offline and no snapshot of %s' % (
+                    ', '.join(fetch)))
+                sources = [x for x in sources if x not in fetch]
+                fetch = []
+            if fetch:
+                print('Processing feeds. This may take a few moments.')
+            self.log.debug('Loading feeds: %s (from snapshot: %s)' % (
+                ', '.join(fetch), ', '.join(x for x in sources
+                                            if x not in fetch)))
+
+            # Fetch and parse every feed at the same time, but merge the
+            # results in the same order they were always processed in.
+            def source_func(source):
+                if source in self.ios_update_feeds:
+                    return (self.process_ios_feed,
+                            (self.ios_update_feeds[source],))
+                if source == 'mas':
+                    return (self.build_mas_assets, ())
+                return (self.build_su_assets, ())
+
+            pool = ThreadPool(max(1, min(self.feed_workers, len(fetch) or 1)))
+            try:
+                results = dict((source, pool.apply_async(*source_func(source)))
+                               for source in fetch)
+                for source in sources:
+                    if source in results:
+                        entries = results[source].get()
+                        # None means the feed could not be fetched or read
+                        # in full. Anything else, even no entries at all,
+                        # is a complete result.
+                        if entries is None:
+                            entries = []
+                        elif source not in self.unsettled_sources:
+                            self.snapshot.update(source, entries)
+                    else:
+                        entries = stored[source]
+                    [self.add_asset(*entry) for entry in entries]
+                    self.loaded_sources.append(source)
+            finally:
+                pool.close()
+                pool.join()
+
+            if fetch:
+                self.snapshot.save()
         except Exception as e:
             raise
             self.log.debug('%s' % (e))
 
-    # IPSW info is pulled from IPSW.me
+    # Newest firmware of every model, from the ipsw.me listing. It is
+    # fetched at most once per ipsw_index_ttl and kept in memory for the run.
+    # None if it could not be loaded.
+    def ipsw_firmwares(self):
+        with self.ipsw_index_lock:
+            if self.ipsw_index is None:
+                max_age = self.ipsw_index_ttl
+                if self.offline:
+                    max_age = float('inf')
+                try:
+                    self.ipsw_index = self.parse_feed(
+                        self.ipsw_index_url, ipswindex.firmware_index,
+                        max_age=max_age)
+                except Exception as e:
+                    self.log.info('Unable to load firmware index: %s' % (e))
+                    self.ipsw_index = {}
+            return self.ipsw_index or None
+
+    # IPSW info is pulled from IPSW.me, from the firmware index when it is
+    # available and with a request per detail otherwise
     def parse_ipsw(self, model=None):
+        firmwares = self.ipsw_firmwares()
+        if firmwares is not None:
+            firmware = firmwares.get(model)
+            if not firmware:
+                self.log.info('No IPSW listed for %s' % (model))
+                return
+            meta = {}
+            if firmware.sha1:
+                meta['sha1'] = firmware.sha1
+            if firmware.size:
+                meta['size'] = firmware.size
+            self.add_asset(model, firmware.version, firmware.url, 'ipsw',
+                           meta)
+            return
+
         try:
             url = 'https://api.ipsw.me/v2.1/%s/latest/url' % (model)
             req = self.url_request(url)
@@ -539,13 +858,25 @@ class PreCache(object):
             version = req.read()
             req.close()
 
-            self.add_asset(model, version, url, 'ipsw')
+            meta = {}
+            sha1 = 'https://api.ipsw.me/v2.1/%s/latest/sha1sum' % (model)
+            req = self.url_request(sha1)
+            if req:
+                sha1 = req.read().strip().lower()
+                req.close()
+                if re.match('^[0-9a-f]{40}$', sha1):
+                    meta['sha1'] = sha1
+
+            self.add_asset(model, version, url, 'ipsw', meta)
         except Exception as e:
             self.log.debug('%s' % (e))
 
     # List assets that are cacheable
     def list_assets(self, group=None):
         try:
+            self.build_asset_master_list(
+                self.sources_for(group=group) if group else None)
+
             display_order = ['AppleTV',
                              'iPad',
                              'iPhone',
@@ -555,35 +886,15 @@ class PreCache(object):
                              'installer',
                              'updates']
 
-            def keyfunc(s):
-                return [int(''.join(g)) if k else ''.join(g) for k, g in
-                        groupby(s, str.isdigit)]
-
-            ListGroup = collections.namedtuple('ListGroup', ['model',
-                                                             'group'])
-            assets_list = []
-            for item in self.assets_master:
-                asset_info = ListGroup(
-                    model=item.model,
-                    group=item.group
-                )
-                if asset_info not in assets_list:
-                    assets_list.append(asset_info)
-
-            assets_list.sort()
-            sorted(assets_list, key=attrgetter('model'))
-
             if group:
                 for g in group:
-                    [print('%s' % (item.model))
-                     for item in assets_list
-                     if g in item.group]
+                    [print('%s' % (m))
+                     for m in sorted(self.assets_master.models(groups=[g]))]
             else:
                 for x in display_order:
                     print('Group: %s' % (x))
-                    [print('  %s' % (m.model))
-                     for m in assets_list
-                     if x in m.group]
+                    [print('  %s' % (m))
+                     for m in sorted(self.assets_master.models(groups=[x]))]
         except Exception as e:
             self.log.debug('%s' % (e))
 
@@ -599,7 +910,10 @@ class PreCache(object):
         return path
 
     # Add the asset to the assets_master list
-    def add_asset(self, asset_model, asset_version, asset_url, asset_group):
+    # Feed entries may carry a dict of details about the URL (such as its
+    # expected sha1), which the catalog keeps alongside the asset
+    def add_asset(self, asset_model, asset_version, asset_url, asset_group,
+                  meta=None):
         try:
             asset_url = self.convert_url(asset_url)
             asset = self.Asset(
@@ -610,19 +924,13 @@ class PreCache(object):
             )
 
             if asset_group != 'ipsw':
-                if asset not in self.assets_master:
-                    self.assets_master.append(asset)
+                if self.assets_master.add(asset, meta):
                     self.log.debug('Added %s %s' % (asset.model, asset.url))
                 else:
                     self.log.debug('Skipped %s %s' % (asset.model, asset.url))
 
-                if asset_group not in ['Watch', 'installer', 'app', 'updates']:
-                    if asset_model not in self.ipsw_models_master:
-                        self.ipsw_models_master.append(asset.model)
-
             if asset_group == 'ipsw':
-                if asset not in self.ipsw_assets_master:
-                    self.ipsw_assets_master.append(asset)
+                self.ipsw_assets_master.add(asset, meta)
 
         except Exception as e:
             self.log.debug('Error adding %s - %s' % (asset.model, e))
@@ -652,11 +960,6 @@ class PreCache(object):
         else:
             return False
 
-    def rand_sleep(self):
-        pause = uniform(1, 5)
-        self.log.info('Sleeping for %s to avoid hammering servers' % (pause))
-        sleep(pause)
-
     # Makes file sizes human friendly
     def convert_size(self, file_size, precision=2):
         try:
@@ -675,8 +978,9 @@ class PreCache(object):
         try:
             model_stats = 'Caching: %s (%s)' % (asset.model, asset.version)
             progress = '[%0.2f%% of %s]' % (percent, human_fs)
-            sys.stdout.write("\r%s %s" % (model_stats, progress))
-            sys.stdout.flush()
+            with self.output_lock:
+                sys.stdout.write("\r%s %s" % (model_stats, progress))
+                sys.stdout.flush()
         except Exception as e:
             self.log.debug('%s' % (e))
 
@@ -685,33 +989,196 @@ class PreCache(object):
         folder = self.expand_path(store_in) if store_in else '/tmp/precache'  # NOQA
         try:
             # Clean up in case --cache-ipsw-group is called with --ipsw
-            self.ipsw_assets_master = []
+            self.ipsw_assets_master = catalog.AssetCatalog()
 
             if model:
                 for m in model:
                     self.parse_ipsw(m)
-                    # Sleep a random interval to avoid hammering the API
-                    self.rand_sleep()
 
             if group:
+                self.build_asset_master_list(self.sources_for(group=group))
                 for g in group:
                     [self.parse_ipsw(x)
                      for x in self.ipsw_models_master
                      if g in x]
-                    # Sleep a random interval to avoid hammering the API
-                    self.rand_sleep()
 
-            [self.download(asset, keep_file=True, store_in=folder)
-             for asset in
-             self.ipsw_assets_master]
+            if not self.dry_run and not os.path.isdir(folder):
+                os.makedirs(folder)
+                self.log.debug('Created folder %s' % (folder))
+
+            scheduler = self.download_scheduler(
+                lambda asset: self.download(asset, keep_file=True,
+                                            store_in=folder))
+            # Many models share one universal IPSW, which is only fetched
+            # once. The manifest records every model it serves.
+            for url in self.ipsw_assets_master.urls():
+                asset = self.ipsw_assets_master.by_url(url)[0]
+                models = self.ipsw_models_for(asset)
+                if len(models) > 1:
+                    self.log.info('%s serves %s' % (
+                        os.path.basename(url), ', '.join(models)))
+                if not self.already_stored(asset, folder):
+                    scheduler.submit(asset, self.asset_weight(asset))
+            scheduler.run()
 
         except Exception as e:
             self.log.debug('%s' % (e))
             raise
 
+    # Manifest of the files saved in folder, shared by every download to it
+    def store_manifest(self, folder):
+        with self.output_lock:
+            if folder not in self.manifests:
+                self.manifests[folder] = manifest.StoreManifest(folder)
+            return self.manifests[folder]
+
+    # Every model whose IPSW is the file at the asset's URL
+    def ipsw_models_for(self, asset):
+        return sorted(self.ipsw_assets_master.models_for(asset.url))
+
+    # True if the file for asset is already in folder and verified. A file
+    # from before the manifest existed is hashed once and, if it matches the
+    # published sha1, recorded so later runs trust it.
+    def already_stored(self, asset, folder):
+        store = self.store_manifest(folder)
+        filename = os.path.basename(asset.url).split('?')[0]
+        expected = self.asset_meta(asset).get('sha1')
+        stored = store.current(filename, asset.url, expected)
+
+        path = os.path.join(folder, filename)
+        if not stored and expected and os.path.isfile(path):
+            self.log.info('Checking existing %s' % (path))
+            hashers = partial.file_hashers(path)
+            digest = hashers['sha1'].hexdigest()
+            if self.compare_sha1sum(digest, expected):
+                store.record(filename, asset.url, digest,
+                             self.ipsw_models_for(asset),
+                             hashers['sha256'].hexdigest())
+                store.save()
+                stored = True
+        elif stored and store.add_models(filename,
+                                         self.ipsw_models_for(asset)):
+            store.save()
+
+        if stored:
+            with self.output_lock:
+                print('Skipped: %s (%s) - already in %s' % (
+                    asset.model, asset.version, folder))
+            self.log.info('Skipped: %s (%s) - already in %s' % (
+                asset.model, asset.version, folder))
+        return stored
+
+    # Record a kept file in its folder's manifest once it is verified. Only
+    # a file of the full length the server gave (and the size the catalog
+    # lists, if any) is recorded, so a short file is fetched again later.
+    # A sha1 that did not match has already raised ChecksumError.
+    def record_stored(self, part, asset):
+        size = os.path.getsize(part.path)
+        listed = self.asset_meta(asset).get('size')
+        if part.length is None or size != part.length or (
+                listed and size != listed):
+            self.log.error('Not recording %s: %s bytes, expected %s' % (
+                part.path, size, listed or part.length))
+            return
+        store = self.store_manifest(os.path.dirname(part.path))
+        store.record(os.path.basename(part.path), asset.url, part.sha1,
+                     self.ipsw_models_for(asset), part.sha256)
+        store.save()
+
+    # Details the catalog keeps about the asset's URL, such as its sha1
+    def asset_meta(self, asset):
+        if asset.group == 'ipsw':
+            return self.ipsw_assets_master.meta(asset.url)
+        return self.assets_master.meta(asset.url)
+
+    # Number of devices the file at the asset's URL serves, across every
+    # model that shares it
+    def asset_weight(self, asset):
+        if asset.group == 'ipsw':
+            models = self.ipsw_assets_master.models_for(asset.url)
+        else:
+            models = self.assets_master.models_for(asset.url)
+        return sum(self.model_weights.get(model, 0) for model in models)
+
+    # Leave out the delta OTAs that install over builds no device in the
+    # fleet is running
+    def fleet_assets(self, assets):
+        if not self.fleet_builds:
+            return assets
+        kept = [asset for asset in assets if fleet.wanted(
+            asset.model, self.asset_meta(asset).get('prerequisite'),
+            self.fleet_builds)]
+        # OTA entries read without their PrerequisiteBuild can not be told
+        # apart from full updates, so they are all kept
+        unknown = [asset for asset in assets
+                   if asset.group not in ('app', 'installer', 'updates') and
+                   'prerequisite' not in self.asset_meta(asset)]
+        if unknown:
+            self.log.warning('Fleet builds: %s OTA assets have no '
+                             'PrerequisiteBuild details and are all kept' % (
+                                 len(unknown)))
+        self.log.info('Fleet builds: %s of %s assets needed' % (
+            len(kept), len(assets)))
+        return kept
+
+    # Queue of downloads run concurrently, a few at a time per origin
+    def download_scheduler(self, worker):
+        return scheduler.DownloadScheduler(
+            worker, workers=self.download_workers, per_host=self.per_host)
+
+    # User agent the caching server is sent for an asset
+    def asset_user_agent(self, asset):
+        if asset.group:
+            return self.user_agents[asset.group]
+        return 'precache/%s' % (self.version)
+
+    # Ask the caching server for one byte of each asset to find out which
+    # ones it already holds. Returns the assets that still need a transfer.
+    def preflight(self, assets):
+        assets = catalog.one_per_url(assets)
+        if self.dry_run or not assets:
+            return assets
+
+        statuses = self.prober.cache_status(
+            (asset.url, {'User-Agent': self.asset_user_agent(asset)})
+            for asset in assets)
+        self.cache_status.update(statuses)
+
+        uncached = []
+        counts = collections.Counter()
+        transfer_size = 0
+        for asset in assets:
+            status = statuses[asset.url]
+            counts[status.state] += 1
+            if status.state == probe.CACHED:
+                with self.output_lock:
+                    print('Skipped: %s (%s) - in cache' % (
+                        asset.model, asset.version))
+                self.log.info('Skipped: %s (%s) - in cache' % (
+                    asset.model, asset.version))
+            elif status.state == probe.MISSING:
+                with self.output_lock:
+                    print('Skipped: %s (%s) - not found' % (
+                        asset.model, asset.version))
+                self.log.info('Skipped: %s (%s) - not found %s' % (
+                    asset.model, asset.version, asset.url))
+            else:
+                uncached.append(asset)
+                transfer_size += status.size or 0
+
+        self.log.info('Pre-flight: %s cached, %s missing, %s to fetch (%s)' % (
+            counts[probe.CACHED], counts[probe.MISSING], len(uncached),
+            self.convert_size(transfer_size)))
+        return uncached
+
     # Cache assets
     def cache_assets(self, model=None, group=None):
         try:
+            self.build_asset_master_list(
+                self.sources_for(model=model, group=group))
+            scheduler = self.download_scheduler(self.download)
+            assets = []
+
             if model:
                 self.log.info(
                     'Beginning precache run for models: %s' % (
@@ -719,8 +1186,7 @@ class PreCache(object):
                     )
                 )
                 for m in model:
-                    [self.download(item) for item in self.assets_master
-                     if m == item.model]
+                    assets.extend(self.assets_master.by_model(m))
 
             if group:
                 self.log.info(
@@ -729,15 +1195,23 @@ class PreCache(object):
                     )
                 )
                 for g in group:
-                    [self.download(item)
-                     for item in self.assets_master
-                     if item.group in g]
+                    assets.extend(self.assets_master.by_group(g))
+
+            # An update shared by several of the models is fetched once
+            assets = catalog.one_per_url(self.fleet_assets(assets))
+
+            # Assets the caching server already holds are not downloaded.
+            # The rest go in order of the devices they serve.
+            [scheduler.submit(item, self.asset_weight(item))
+             for item in self.preflight(assets)]
+            scheduler.run()
 
         except Exception as e:
             raise
             self.log.debug('%s' % (e))
 
-    # Download the asset
+    # Download the asset. Kept files are written to a .part file first, so
+    # an interrupted download carries on where it stopped on the next run.
     def download(self, asset, keep_file=False, store_in=None):
         lf = os.path.basename(asset.url)
         lf = lf.split('?')[0]
@@ -751,102 +1225,239 @@ class PreCache(object):
                 if not os.path.isdir(store_in):
                     os.mkdir(folder)
                     self.log.debug('Created folder %s' % (folder))
-        else:
-            lf = os.path.join(os.devnull, lf)
-
-        try:
-            f = open(lf, 'wb')
-        except:
-            pass
 
         if not self.dry_run:
+            part = None
+            req = None
+            expected = self.asset_meta(asset).get('sha1')
             try:
                 if self.extension_check(asset):
-                    if asset.group:
-                        ua = self.user_agents[asset.group]
-                    else:
-                        ua = 'precache/%s' % (self.version)
-
-                    req = self.url_request(asset.url, user_agent=ua)
+                    headers = {}
+                    if (keep_file and self.segments > 1 and
+                            self.download_segmented(asset, lf)):
+                        return
+                    if keep_file:
+                        part = partial.PartialDownload(lf, asset.url)
+                        if part.finished:
+                            part.finish(expected)
+                            self.record_stored(part, asset)
+                            self.log.info('Completed %s from part file' % (
+                                lf))
+                            return
+                        headers = part.request_headers()
+
+                    ua = self.asset_user_agent(asset)
+                    req = self.url_request(asset.url, user_agent=ua,
+                                           headers=headers)
 
                     try:
                         req_header = req.info().getheader('Content-Type')
                     except AttributeError:
                         req_header = None
 
-                    if req_header is not None:
-                        try:
-                            self.log.debug(
-                                ' Fetch attempt: %s' % (asset.url)
-                            )
-                            ts = req.info().getheader('Content-Length').strip()
-                            human_fs = self.convert_size(float(ts))
-                            header = True
-                        except AttributeError:
-                            header = False
-                            human_fs = 0
-
-                        if header:
-                            ts = int(ts)
-                            bytes_so_far = 0
-                            self.log.info(
-                                'Downloading %s (%s) %s' % (asset.model,
-                                                            asset.version,
-                                                            asset.url)
-                            )
+                    # Files being kept are saved whether or not the caching
+                    # server already had them
+                    if req_header is not None or (keep_file and req):
+                        bytes_so_far = 0
+                        if part:
+                            try:
+                                bytes_so_far = part.start(req)
+                            except partial.ResumeError as e:
+                                # The part file is gone, ask for all of it
+                                self.log.info('%s, starting over' % (e))
+                                req.close()
+                                req = self.url_request(asset.url,
+                                                       user_agent=ua)
+                                if req is None:
+                                    raise urllib2.URLError(
+                                        'Unable to download %s' % (
+                                            asset.url))
+                                bytes_so_far = part.start(req)
+                            ts = part.length
+                        else:
+                            ts = req.info().getheader('Content-Length')
+                            ts = int(ts) if ts and ts.isdigit() else None
+                        human_fs = self.convert_size(float(ts)) if ts else 0
+
+                        self.log.debug(' Fetch attempt: %s' % (asset.url))
+                        self.log.info(
+                            'Downloading %s (%s) %s' % (asset.model,
+                                                        asset.version,
+                                                        asset.url)
+                        )
+
+                        # The sha1 is worked out from the data as it
+                        # arrives. Kept files do this in the part file.
+                        hasher = None
+                        if expected and not part:
+                            hasher = hashlib.sha1()
 
+                        # One buffer per download, filled in place from the
+                        # socket and written out from a view of it
+                        buffer = bytearray(self.chunk_size)
+                        view = memoryview(buffer)
                         while True:
-                            buffer = req.read(8192)
-                            if not buffer:
-                                print('')
+                            received = req.readinto(buffer)
+                            if not received:
+                                with self.output_lock:
+                                    print('')
                                 break
 
-                            bytes_so_far += len(buffer)
+                            bytes_so_far += received
 
-                            if keep_file:
-                                f.write(buffer)
+                            if part:
+                                part.write(view[:received])
+                            elif hasher:
+                                hasher.update(view[:received])
 
-                            if not header:
-                                ts = bytes_so_far
-
-                            percent = float(bytes_so_far) / ts
+                            percent = float(bytes_so_far) / (
+                                ts or bytes_so_far)
                             percent = round(percent*100, 2)
 
                             self.progress_output(asset, percent, human_fs)
                         req.close()
+                        if part:
+                            if not part.finish(expected):
+                                return
+                            self.record_stored(part, asset)
+                        if hasher and not self.compare_sha1sum(
+                                hasher.hexdigest(), expected):
+                            raise partial.ChecksumError(
+                                '%s: expected sha1 %s, got %s' % (
+                                    asset.url, expected, hasher.hexdigest()))
                         self.log.info('Cached %s (%s) %s' % (asset.model,
                                                              asset.version,
                                                              asset.url))
+                    elif req is None and keep_file:
+                        with self.output_lock:
+                            print('Unable to download %s (%s)' % (
+                                asset.model, asset.version))
+                        self.log.info('Unable to download %s' % (asset.url))
                     else:
                         try:
                             req.close()
                         except AttributeError:
                             pass
-                        print(
-                            'Skipped: %s (%s) - in cache' % (
-                                asset.model, asset.version
-                                )
-                             )
+                        with self.output_lock:
+                            print('Skipped: %s (%s) - in cache' % (
+                                asset.model, asset.version))
                         self.log.info(
                             'Skipped: %s (%s) - in cache' % (
                                 asset.model, asset.version
                             )
                         )
             except (urllib2.URLError, urllib2.HTTPError) as e:
-                req.close()
-                print('%s' % (e))
-                print('Check Caching Server is correct')
+                if req:
+                    req.close()
+                with self.output_lock:
+                    print('%s' % (e))
+                    print('Check Caching Server is correct')
                 self.log.info('%s - %s' % (e, asset.url))
                 pass
-
-            # Sleep for a random interval
-            self.rand_sleep()
+            except partial.ChecksumError as e:
+                with self.output_lock:
+                    print('Checksum mismatch: %s (%s)' % (
+                        asset.model, asset.version))
+                self.log.error('%s' % (e))
+                raise
+            finally:
+                if part:
+                    part.close()
         else:
-            print('DRY RUN: Caching %s (%s) %s' % (
-                asset.model, asset.version, asset.url
-                )
-            )
+            with self.output_lock:
+                print('DRY RUN: Caching %s (%s) %s' % (
+                    asset.model, asset.version, asset.url))
             self.log.info('DRY RUN: Caching %s (%s) %s' % (
                 asset.model, asset.version, asset.url
                 )
             )
+
+    # Fetch a kept file as several byte ranges at once. Returns False, for a
+    # plain download instead, if the server does not serve ranges or the
+    # file is too small to be worth splitting.
+    def download_segmented(self, asset, lf):
+        part = partial.SegmentedDownload(lf, asset.url)
+        expected = self.asset_meta(asset).get('sha1')
+        if part.finished:
+            part.finish(expected)
+            self.record_stored(part, asset)
+            return True
+
+        ua = self.asset_user_agent(asset)
+        req = self.url_request(asset.url, user_agent=ua,
+                               headers={'Range': 'bytes=0-0'})
+        if req is None:
+            return False
+        try:
+            info = req.info()
+            content_range = partial.CONTENT_RANGE.match(
+                info.getheader('Content-Range') or '')
+            if (req.getcode() != 206 or not content_range or
+                    not content_range.group(3).isdigit()):
+                return False
+            req.read()
+        finally:
+            req.close()
+        length = int(content_range.group(3))
+        if not part.plan(length, info.getheader('ETag'),
+                         info.getheader('Last-Modified'),
+                         count=self.segments):
+            return False
+
+        pending = part.pending()
+        self.log.info('Downloading %s (%s) %s in %d segments' % (
+            asset.model, asset.version, asset.url, len(pending)))
+        human_fs = self.convert_size(float(length))
+        pool = ThreadPool(len(pending))
+        try:
+            pool.map(lambda index: self.fetch_segment(
+                asset, part, index, ua, human_fs), pending)
+        finally:
+            pool.close()
+            pool.join()
+        with self.output_lock:
+            print('')
+
+        if part.finish(expected):
+            self.record_stored(part, asset)
+            self.log.info('Cached %s (%s) %s' % (
+                asset.model, asset.version, asset.url))
+        else:
+            with self.output_lock:
+                print('Incomplete: %s (%s) - will resume on the next run' % (
+                    asset.model, asset.version))
+        return True
+
+    # Fetch one segment of a SegmentedDownload into its place in the file
+    def fetch_segment(self, asset, part, index, ua, human_fs):
+        req = self.url_request(asset.url, user_agent=ua,
+                               headers=part.segment_headers(index))
+        if req is None:
+            return False
+        f = None
+        try:
+            if not part.check_segment(index, req):
+                self.log.info('Segment %d of %s was not sent as asked' % (
+                    index, asset.url))
+                return False
+            f = part.open_segment(index)
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            while True:
+                received = req.readinto(buffer)
+                if not received:
+                    break
+                f.write(view[:received])
+                part.advance(index, received)
+
+                percent = round(float(part.offset) / part.length * 100, 2)
+                self.progress_output(asset, percent, human_fs)
+            return True
+        except (httplib.HTTPException, socket.error, IOError) as e:
+            self.log.info('Segment %d of %s failed: %s' % (
+                index, asset.url, e))
+            return False
+        finally:
+            req.close()
+            if f:
+                f.close()
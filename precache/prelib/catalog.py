@@ -0,0 +1,101 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEXED_FIELDS = ("model", "group", "url", "version")
+
+
+class AssetCatalog(object):
+    """Ordered, de-duplicated collection of Asset tuples.
+
+    Adding an asset and checking membership are constant time, and assets
+    can be looked up by model, group, URL or version through secondary
+    indexes instead of scanning the whole catalog. Iteration is in the order
+    assets were first added.
+
+    Extra details about a URL that are not part of the Asset tuple, such as
+    the expected digest, are kept per URL and read back with meta().
+
+    A file that serves many models, such as an OTA update listing several
+    devices, has one asset per model sharing its URL. The model and URL
+    indexes together map models to URLs and back.
+    """
+    def __init__(self, assets=()):
+        self._assets = collections.OrderedDict()
+        self._indexes = dict((field, collections.OrderedDict())
+                             for field in INDEXED_FIELDS)
+        self._meta = {}
+        for asset in assets:
+            self.add(asset)
+
+    def __contains__(self, asset):
+        return asset in self._assets
+
+    def __iter__(self):
+        return iter(self._assets)
+
+    def __len__(self):
+        return len(self._assets)
+
+    def add(self, asset, meta=None):
+        """Adds asset, and merges meta into the details kept for its URL.
+        Returns False if the asset was already in the catalog."""
+        if meta:
+            self._meta.setdefault(asset.url, {}).update(meta)
+        if asset in self._assets:
+            return False
+        self._assets[asset] = None
+        for field, index in self._indexes.items():
+            index.setdefault(getattr(asset, field), []).append(asset)
+        return True
+
+    def meta(self, url):
+        """Returns the details kept for url, {} if there are none."""
+        return dict(self._meta.get(url, {}))
+
+    def _lookup(self, field, value):
+        return list(self._indexes[field].get(value, []))
+
+    def by_model(self, model):
+        return self._lookup("model", model)
+
+    def by_group(self, group):
+        return self._lookup("group", group)
+
+    def by_url(self, url):
+        return self._lookup("url", url)
+
+    def by_version(self, version):
+        return self._lookup("version", version)
+
+    def urls(self):
+        """Returns the distinct URLs, in the order first seen."""
+        return list(self._indexes["url"])
+
+    def models_for(self, url):
+        """Returns the distinct models the file at url serves."""
+        return list(collections.OrderedDict.fromkeys(
+            asset.model for asset in self.by_url(url)))
+
+    def models(self, groups=None, exclude=()):
+        """Returns the distinct models, in the order first seen, that have an
+        asset in one of groups (or any group), leaving out those only found
+        in excluded groups."""
+        return [model for model, assets in self._indexes["model"].items()
+                if any((groups is None or a.group in groups) and
+                       a.group not in exclude for a in assets)]
+
+
+def one_per_url(assets):
+    """Returns the first of assets for each distinct URL, in order, so that
+    a file serving many models is only fetched once."""
+    first = collections.OrderedDict()
+    for asset in assets:
+        first.setdefault(asset.url, asset)
+    return list(first.values())
@@ -0,0 +1,229 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import cPickle
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib2
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+FEED_TIMEOUT = 30
+
+
+class FeedCache(object):
+    """Persistent on-disk cache of feed bodies.
+
+    Each body is stored together with the ETag and Last-Modified headers it
+    was served with. Opening a cached URL revalidates it with If-None-Match and
+    If-Modified-Since, and a 304 response is answered from disk. A parsed copy
+    of the body can be kept next to it so an unchanged feed is not parsed again.
+
+    With mirror=True the bodies are stored at the same relative path as the
+    URL under cache_dir, rather than under a hashed name.
+    """
+    def __init__(self, cache_dir, mirror=False, opener=None,
+                 timeout=FEED_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.mirror = mirror
+        self.opener = opener or urllib2.build_opener()
+        self.timeout = timeout
+
+    def _paths(self, url):
+        if self.mirror:
+            body = os.path.join(
+                self.cache_dir,
+                os.path.normpath(urlparse.urlsplit(url).path.lstrip("/")))
+        else:
+            body = os.path.join(self.cache_dir,
+                                hashlib.sha1(url).hexdigest())
+        return body, body + ".meta", body + ".parsed"
+
+    def _load_meta(self, url):
+        body, meta, _ = self._paths(url)
+        if not os.path.exists(body):
+            return {}
+        try:
+            with open(meta, "rb") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_atomic(self, path, write):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _makedirs(self, path):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder, 0o755)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+
+    def open(self, url, headers=None, max_age=None):
+        """Opens url, revalidating any cached copy. Returns a file-like
+        response; response.from_cache is True when the body is served from
+        disk. A copy fetched less than max_age seconds ago is served without
+        revalidating it. Errors other than a 304 are raised as from
+        urllib2."""
+        body, _, _ = self._paths(url)
+        meta = self._load_meta(url)
+        if (meta and max_age is not None and
+                time.time() - meta.get("fetched", 0) < max_age):
+            logger.debug("Fresh copy, not revalidating: %s" % url)
+            return CachedResponse(url, open(body, "rb"), meta)
+        request = urllib2.Request(url, headers=headers or {})
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and meta:
+                logger.debug("Not modified, using cached copy: %s" % url)
+                return CachedResponse(url, open(body, "rb"), meta)
+            raise
+
+        self._makedirs(body)
+        return TeeResponse(url, response, self)
+
+    def parse(self, response, parse, key=None):
+        """Returns parse(response), reusing the stored parsed result when
+        the response was served from disk. The stored result is only reused
+        if it was made with the same key, which defaults to the name of the
+        parse function."""
+        _, _, parsed = self._paths(response.url)
+        key = key or parse.__name__
+        if response.from_cache and os.path.exists(parsed):
+            try:
+                with open(parsed, "rb") as f:
+                    stored_key, result = cPickle.load(f)
+                if stored_key == key:
+                    # The body is not needed after all
+                    response.close()
+                    return result
+            except (IOError, OSError, EOFError, ValueError,
+                    cPickle.UnpicklingError):
+                logger.debug("Discarding unreadable parsed cache: %s" % parsed)
+
+        try:
+            result = parse(response)
+            response.drain()
+        finally:
+            response.close()
+        if response.committed or response.from_cache:
+            try:
+                self._write_atomic(
+                    parsed, lambda f: cPickle.dump((key, result), f, 2))
+            except (IOError, OSError) as e:
+                logger.debug("Unable to store parsed feed: %s" % e)
+        return result
+
+    def _commit(self, url, tmp, info):
+        body, meta, parsed = self._paths(url)
+        os.rename(tmp, body)
+        if os.path.exists(parsed):
+            os.unlink(parsed)
+        record = {
+            "url": url,
+            "etag": info.getheader("ETag"),
+            "last_modified": info.getheader("Last-Modified"),
+            "fetched": time.time(),
+        }
+        self._write_atomic(meta, lambda f: json.dump(record, f))
+        logger.debug("Stored %s in feed cache" % url)
+
+
+class CachedResponse(object):
+    """A feed body served from the cache after a 304."""
+    from_cache = True
+    committed = False
+
+    def __init__(self, url, fp, meta):
+        self.url = url
+        self.fp = fp
+        self.meta = meta
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def drain(self, chunk_size=65536):
+        pass
+
+    def info(self):
+        return None
+
+    def getcode(self):
+        return 304
+
+    def close(self):
+        self.fp.close()
+
+
+class TeeResponse(object):
+    """Wraps a live response, copying the body into the cache as it is read.
+    The copy is only committed once the body has been read to the end."""
+    from_cache = False
+
+    def __init__(self, url, response, cache):
+        self.url = url
+        self.response = response
+        self.cache = cache
+        self.committed = False
+        self._complete = False
+        body, _, _ = cache._paths(url)
+        fd, self._tmp = tempfile.mkstemp(
+            dir=os.path.dirname(body), suffix=".tmp")
+        self._fp = os.fdopen(fd, "wb")
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            self._fp.write(data)
+        elif size != 0:
+            self._complete = True
+        if size < 0:
+            self._complete = True
+        return data
+
+    def drain(self, chunk_size=65536):
+        while not self._complete:
+            self.read(chunk_size)
+
+    def info(self):
+        return self.response.info()
+
+    def getcode(self):
+        return self.response.getcode()
+
+    def close(self):
+        if self._fp.closed:
+            return
+        self._fp.close()
+        self.response.close()
+        if self._complete:
+            try:
+                self.cache._commit(self.url, self._tmp, self.response.info())
+                self.committed = True
+            except (IOError, OSError) as e:
+                logger.debug("Unable to store %s: %s" % (self.url, e))
+        if os.path.exists(self._tmp):
+            os.unlink(self._tmp)
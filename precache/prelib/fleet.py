@@ -0,0 +1,44 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def load_builds(path):
+    """Reads the OS builds the fleet runs, per model, from path. The file is
+    either JSON, {"iPhone8,2": ["16C101", "16D57"], ...}, or lines of
+    'model build', as model identifiers have commas in them. Returns a dict
+    of model to a set of builds."""
+    with open(path, "rb") as f:
+        text = f.read()
+    builds = {}
+    try:
+        listing = json.loads(text)
+    except ValueError:
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith("#"):
+                continue
+            builds.setdefault(fields[0], set()).add(fields[1])
+    else:
+        for model, model_builds in listing.items():
+            if isinstance(model_builds, basestring):
+                model_builds = [model_builds]
+            builds[str(model)] = set(str(build) for build in model_builds)
+    logger.debug("Fleet builds for %d models from %s" % (len(builds), path))
+    return builds
+
+
+def wanted(model, prerequisite, builds):
+    """True if an OTA for model that installs over the prerequisite build is
+    of use to the fleet in builds. Full OTAs, which have no prerequisite,
+    are always wanted, as are the OTAs of models the fleet has no builds
+    listed for."""
+    if not prerequisite or model not in builds:
+        return True
+    return prerequisite in builds[model]
@@ -25,16 +25,22 @@ for path in PYTHON_FRAMEWORK_PATHS:
     if path not in sys.path:
         sys.path.append(path)
 
+import base64
+import httplib
 import logging
 import os
 import socket
 import ssl
+import threading
 import urlparse
 import urllib2
+from StringIO import StringIO
+from precache.prelib import feedcache
 from precache.prelib import macintosh
 
 __all__ = [
-    "Location", "Internet", "Network"
+    "Location", "Request", "HTTPClient", "client", "configure_client",
+    "replicate_url"
     ]
 
 logger = logging.getLogger(__name__)
@@ -164,6 +170,8 @@ class PosixLocation(Location):
 class Request(object):
     def __init__(self, url, proxy=None, headers=None):
         self.url = Location(url)
+        self.proxy = None
+        self.headers = {}
         self.add_proxy(proxy=proxy)
         self.add_headers(headers=headers)
 
@@ -188,22 +196,17 @@ class Request(object):
                 self.headers.update({k: v})
 
     def _build_opener(self):
-        https_context = urllib2.HTTPSHandler(
-            context=ssl.SSLContext(ssl.PROTOCOL_TLS))
-        opener = urllib2.build_opener(https_context)
-        if self.proxy and check_proxy(self.proxy):
+        if self.proxy:
             logger.debug("Adding proxy support via: " + self.proxy)
-            proxy_support = urllib2.ProxyHandler(
-                {"http": self.proxy, "https": self.proxy})
-            opener.add_handler(proxy_support)
-        return opener
+            return HTTPClient(proxy=self.proxy)
+        return client()
 
     def _request(self, url, headers=None):
         logger.debug("Request: URL: {}".format(url))
         request = urllib2.Request(url)
         if headers:
             logger.debug("Adding headers: " + str(headers))
-            request.add_header(headers)
+            request.add_header(*headers)
         logger.debug("URLOpen: Request: %s :: Timeout: %d" %
                      (str(request), URL_TIMEOUT))
         return request
@@ -226,6 +229,7 @@ class Request(object):
         try:
             ba_response = ba_opener.open(ba_request, timeout=URL_TIMEOUT)
         except (urllib2.URLError, urllib2.HTTPError) as e:
+            logger.debug("Basic auth request failed: {}".format(e))
             return False
         else:
             return ba_response
@@ -236,12 +240,262 @@ class NetworkRequest(urllib2.HTTPSHandler):
         super(NetworkRequest, self).__init__(*args, **kwargs)
 
 
+class HTTPClient(object):
+    """HTTP client that keeps persistent connections to each host.
+
+    Idle connections are pooled per scheme, host and port (up to
+    'max_idle' each) and reused by later requests, so many small requests
+    to the same host share one TCP connection and, for HTTPS, one TLS
+    handshake. All HTTPS connections use a single SSLContext. Requests can
+    go through an HTTP proxy ("host:port"), tunnelling HTTPS with CONNECT.
+
+    open() behaves like a urllib2 opener: it takes a URL or urllib2.Request,
+    follows redirects, returns a file-like response with info(), getcode()
+    and geturl(), and raises urllib2.HTTPError for 304 and error statuses
+    and urllib2.URLError when the host cannot be reached.
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+    max_redirects = 5
+
+    def __init__(self, timeout=URL_TIMEOUT, proxy=None, max_idle=8,
+                 context=None):
+        self.timeout = timeout
+        self.proxy = proxy
+        self.max_idle = max_idle
+        self.context = context or ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def configure(self, timeout=None, proxy=None):
+        """Changes the timeout or proxy. Pooled connections are dropped."""
+        if timeout is not None:
+            self.timeout = timeout
+        if proxy is not None:
+            self.proxy = proxy or None
+        self.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    def _connection(self, key, timeout):
+        with self._lock:
+            pool = self._pools.get(key)
+            conn = pool.pop() if pool else None
+        if conn is not None:
+            # The socket still has the timeout of the request it was
+            # opened for
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, host, port = key
+        if self.proxy:
+            p_host, _, p_port = self.proxy.partition(":")
+            p_port = int(p_port or 8080)
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(
+                    p_host, p_port, timeout=timeout, context=self.context)
+                conn.set_tunnel(host, port)
+            else:
+                conn = httplib.HTTPConnection(p_host, p_port, timeout=timeout)
+        elif scheme == "https":
+            conn = httplib.HTTPSConnection(
+                host, port, timeout=timeout, context=self.context)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def _release(self, key, conn, will_close):
+        if not will_close:
+            with self._lock:
+                pool = self._pools.setdefault(key, [])
+                if len(pool) < self.max_idle:
+                    pool.append(conn)
+                    return
+        conn.close()
+
+    def _send(self, method, url, headers, data, timeout):
+        split_url = urlparse.urlsplit(url)
+        scheme = split_url.scheme.lower()
+        port = split_url.port or (443 if scheme == "https" else 80)
+        key = (scheme, split_url.hostname, port)
+        if self.proxy and scheme == "http":
+            path = url
+        else:
+            path = split_url.path or "/"
+            if split_url.query:
+                path += "?" + split_url.query
+
+        # A pooled connection may have been closed by the server while idle,
+        # in which case the request is sent again on a fresh one.
+        for attempt in range(2):
+            conn, reused = self._connection(key, timeout)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise urllib2.URLError(e)
+            return PooledResponse(self, key, conn, response, url)
+
+    def open(self, request, data=None, timeout=None):
+        if not isinstance(request, urllib2.Request):
+            request = urllib2.Request(request, data)
+        timeout = timeout or self.timeout
+        method = request.get_method()
+        url = request.get_full_url()
+        headers = dict(request.header_items())
+        data = request.get_data()
+
+        for _ in range(self.max_redirects + 1):
+            logger.debug("HTTPClient: {} {}".format(method, url))
+            response = self._send(method, url, headers, data, timeout)
+            code = response.getcode()
+            location = response.info().getheader("Location")
+            if code in self.redirect_codes and location:
+                response.discard()
+                url = urlparse.urljoin(url, location)
+                if code == 303:
+                    method, data = "GET", None
+                continue
+            if code == 304 or code >= 400:
+                body = response.discard()
+                raise urllib2.HTTPError(url, code, response.msg,
+                                        response.info(), StringIO(body))
+            return response
+        raise urllib2.URLError("Too many redirects: {}".format(url))
+
+
+class PooledResponse(object):
+    """Response from HTTPClient. The connection goes back to the pool once
+    the body has been read to the end, or is dropped if it is closed early."""
+    def __init__(self, client, key, conn, response, url):
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        # Replies to HEAD, 204 and 304 and empty bodies have nothing to
+        # read, so the connection is free for the next request already
+        if response.length == 0 and not response.chunked:
+            response.close()
+            self._check_done()
+
+    def _check_done(self):
+        if self._conn and self._response.isclosed():
+            self._client._release(
+                self._key, self._conn, self._response.will_close)
+            self._conn = None
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        self._check_done()
+        return data
+
+    def readinto(self, buffer):
+        """Reads up to len(buffer) bytes of the body into buffer (a bytearray
+        or memoryview) and returns how many were read, 0 at the end.
+
+        A body of known length is received straight from the socket into
+        buffer, so no string is allocated per chunk. Chunked bodies, and
+        responses whose file object has already buffered some of the body,
+        go through read() and are copied into buffer instead.
+        """
+        response = self._response
+        fp = response.fp
+        if fp is None:
+            self._check_done()
+            return 0
+        sock = getattr(fp, "_sock", None)
+        if (response.chunked or response.length is None or
+                not hasattr(sock, "recv_into") or fp._rbuf.tell()):
+            data = self.read(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+
+        view = memoryview(buffer)[:min(len(buffer), response.length)]
+        if not len(view):
+            received = 0
+        else:
+            received = sock.recv_into(view)
+            if not received:
+                # The server went away mid body, the connection is no use
+                self.close()
+                raise httplib.IncompleteRead("")
+            response.length -= received
+        if not response.length:
+            response.close()
+            self._check_done()
+        return received
+
+    def discard(self, limit=65536):
+        """Reads and returns a small body so the connection can be reused;
+        larger bodies are not read and the connection is dropped."""
+        length = self._response.length
+        body = ""
+        if length is not None and length <= limit:
+            body = self.read()
+        self.close()
+        return body
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self._conn:
+            if self._response.isclosed():
+                self._check_done()
+            else:
+                self._conn.close()
+                self._conn = None
+        self._response.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client():
+    """Returns the HTTPClient shared by every request path."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient()
+        return _client
+
+
+def configure_client(timeout=None, proxy=None):
+    """Sets the timeout or proxy of the shared HTTPClient."""
+    if proxy and not check_proxy(proxy):
+        logger.error("Proxy {} is not reachable, not using it".format(proxy))
+        proxy = None
+    client().configure(timeout=timeout, proxy=proxy)
+
+
 def check_proxy(proxy):
     # Verify that proxy server is reachable.
     if not proxy:
         return False
     try:
         p_host, p_port = proxy.split(":")
+        p_port = int(p_port)
     except ValueError:
         logger.error("No proxy port supplied. Using port 8080")
         p_host = proxy
@@ -250,7 +504,7 @@ def check_proxy(proxy):
     try:
         # Attempt to connect to the host/port
         host = socket.gethostbyname(p_host)
-        s = socket.create_connection((host, p_port), 2)
+        socket.create_connection((host, p_port), 2).close()
         return True
     except:
         # If not reachable, return False
@@ -269,42 +523,27 @@ def _recreate_urlpath(url, root_dir):
 
 def replicate_url(url, root_dir="/tmp", caching_server=None, chunk_size=8196):
     """Downloads a URL and stores it in the same relative path on our
-    filesystem. Returns a path to the replicated file."""
+    filesystem. Returns a path to the replicated file. A file replicated on
+    an earlier run is revalidated with a conditional GET and kept as is if
+    the server reports it unchanged."""
     split_url, local_path = _recreate_urlpath(url, root_dir)
-    if not isinstance(url, Request):
-        url = Request(url)
 
     logger.debug("Downloading %s..." % url)
-    with open(local_path, "wb") as f:`
-        headers = {"user-agent": macintosh.SysInfo().app_store_agent()}
-        https_context = urllib2.HTTPSHandler(
-            context=ssl.SSLContext(ssl.PROTOCOL_TLS))
-        opener = urllib2.build_opener(https_context)
-        # Attempt the download. If 404 or other error is found, try again
-        # with the backup_url (which may still fail). The most cromulent
-        # usage of this will be if the caching server lacks the files.
+    headers = {"user-agent": macintosh.SysInfo().app_store_agent()}
+    cache = feedcache.FeedCache(
+        root_dir, mirror=True, opener=client(), timeout=URL_TIMEOUT)
+    try:
+        logger.debug("URLRequest: URL: {0!s} :: Headers: {1!s}"
+                     .format(url, headers))
+        response = cache.open(str(url), headers=headers)
         try:
-            logger.debug("URLRequest: URL: {0!s} :: Headers: {1!s}"
-                         .format(url, headers))
-            request = urllib2.Request(full_url, headers=headers)
-            if PROXY_SERVER:
-                logger.debug("Adding proxy support via: " + PROXY_SERVER)
-                proxy_support = urllib2.ProxyHandler(
-                    {"http": PROXY_SERVER, "https": PROXY_SERVER})
-                opener.add_handler(proxy_support)
-            logger.debug("URLOpen: Request: %s :: Timeout: %d" %
-                         (str(request), URL_TIMEOUT))
-            response = opener.open(request, timeout=URL_TIMEOUT)
-            if total is None:  # no content length header
-                f.write(response.content)
-            else:
-                while True:
-                    chunk = response.read(chunk_size)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-
-        except (urllib2.HTTPError, urllib2.URLError, socket.timeout):
-            logger.error("Unable to connect to host: " + split_url.netloc)
+            response.drain(chunk_size)
+        finally:
+            response.close()
+        if response.from_cache:
+            logger.debug("Unchanged since last replicated: %s" % url)
+
+    except (urllib2.HTTPError, urllib2.URLError, socket.timeout):
+        logger.error("Unable to connect to host: " + split_url.netloc)
 
     return local_path
@@ -0,0 +1,59 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import collections
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Every device and its firmwares in one listing
+IPSW_INDEX_URL = "https://api.ipsw.me/v2.1/firmwares.json/condensed"
+IPSW_INDEX_TTL = 21600
+
+# The firmware a model's IPSW is taken from. size and sha1 are None when
+# the listing does not have them.
+Firmware = collections.namedtuple(
+    "Firmware", ["model", "version", "buildid", "url", "size", "sha1"])
+
+
+def version_key(version):
+    """Sort key that orders '12.1.4' after '12.1' and '9.3.5'."""
+    return tuple(int(part) for part in re.findall(r"\d+", version or ""))
+
+
+def latest_firmwares(listing):
+    """Returns a dict of model to the Firmware of its newest IPSW, from the
+    parsed ipsw.me listing. Signed firmwares win over newer unsigned ones,
+    as they are the ones a device can be restored to."""
+    firmwares = {}
+    for model, device in listing.get("devices", {}).items():
+        candidates = device.get("firmwares") or []
+        signed = [f for f in candidates if f.get("signed")]
+        if signed:
+            candidates = signed
+        if not candidates:
+            continue
+        newest = max(candidates, key=lambda f: (
+            version_key(f.get("version")), f.get("buildid") or ""))
+        size = newest.get("size")
+        sha1 = (newest.get("sha1sum") or "").lower()
+        firmwares[str(model)] = Firmware(
+            model=str(model),
+            version=str(newest.get("version")),
+            buildid=str(newest.get("buildid")),
+            url=str(newest.get("url")),
+            size=int(size) if size else None,
+            sha1=str(sha1) if re.match("^[0-9a-f]{40}$", sha1) else None)
+    return firmwares
+
+
+def firmware_index(fileobj):
+    """Parse function for the feed cache: reads the listing and keeps only
+    the newest firmware of each model."""
+    firmwares = latest_firmwares(json.load(fileobj))
+    logger.debug("Firmware index lists %d models" % len(firmwares))
+    return firmwares
@@ -4,34 +4,338 @@
 # Copyright 2019 Glynn Lane (primalcurve)
 
 import base64
+import collections
+import json
 import logging
-import re
+import os
 import sys
+import tempfile
+import threading
+import time
+import urllib2
+from multiprocessing.pool import ThreadPool
+from xml.parsers import expat
 
-import internet
+from precache.prelib import internet
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536
+PAGE_SIZE = 500
+PAGE_WORKERS = 4
+INVENTORY_TTL = 3600
+
+
+def _ascii(value):
+    return value.encode("ascii", "ignore") if value else value
+
+
+class DeviceListParser(object):
+    """Streaming parse of a Classic API mobiledevices listing.
+
+    The XML is fed in as it arrives and only the <id> and
+    <model_identifier> of each <mobile_device> are kept, so memory grows
+    with the number of devices rather than the size of the listing.
+    """
+    def __init__(self):
+        self.devices = {}
+        self._device = None
+        self._text = None
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+
+    def _start(self, name, attrs):
+        if name == "mobile_device":
+            self._device = {}
+        elif self._device is not None and name in ("id", "model_identifier"):
+            self._text = []
+
+    def _chars(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def _end(self, name):
+        if self._text is not None:
+            self._device[name] = "".join(self._text).strip()
+            self._text = None
+        elif name == "mobile_device":
+            if self._device.get("id") and self._device.get("model_identifier"):
+                self.devices[_ascii(self._device["id"])] = _ascii(
+                    self._device["model_identifier"])
+            self._device = None
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse("", True)
+        return self.devices
+
 
 class JamfRequest(object):
-    def __init__(self, jamf_server):
-        self.jamf_server = (
-            "https://{}.jamfcloud.com/"
-            "JSSResource/mobiledevices".format(jamf_server))
+    """Counts the mobile devices in a Jamf Pro instance by model.
 
-    def mobile_ids(self, user, passwd):
-        return self._jamf_request(
-            user, passwd, r"<model_identifier>(.*?)</model_identifier>")
+    The paged Jamf Pro API (v2/mobile-devices) is used when it is available,
+    with the pages after the first fetched 'workers' at a time. Older
+    servers fall back to the Classic API listing, which is parsed as it
+    streams in rather than read into memory whole.
+    """
+    def __init__(self, jamf_server, page_size=PAGE_SIZE,
+                 workers=PAGE_WORKERS):
+        self.base_url = "https://{}.jamfcloud.com/".format(jamf_server)
+        self.jamf_server = self.base_url + "JSSResource/mobiledevices"
+        self.page_size = page_size
+        self.workers = workers
 
-    def _jamf_request(self, user, passwd, search):
-        jamf_request = urllib2.Request(self.jamf_server)
-        jamf_request.add_header(
-            "Authorization", "Basic {}".format(
-                base64.b64encode("{}:{}".format(user, passwd))))
+    def fetch_devices(self, user, passwd):
+        """Returns a dict of device id to model identifier. Errors are
+        raised as from urllib2, json and expat."""
+        basic = "Basic {}".format(
+            base64.b64encode("{}:{}".format(user, passwd)))
         try:
-            jamf_response = urllib2.urlopen(jamf_request)
-        except (urllib2.URLError, urllib2.HTTPError) as e:
+            return self._api_devices(basic)
+        except urllib2.HTTPError as e:
+            if e.code not in (401, 403, 404):
+                raise
+            logger.debug("Jamf Pro API unavailable ({}), using the "
+                         "Classic API".format(e.code))
+        return self._classic_devices(basic)
+
+    def mobile_devices(self, user, passwd):
+        """Returns a dict of device id to model identifier."""
+        try:
+            return self.fetch_devices(user, passwd)
+        except (urllib2.URLError, urllib2.HTTPError, ValueError,
+                expat.ExpatError) as e:
             logger.error("Can not load models from jamf: {}".format(e))
             sys.exit(1)
+
+    def mobile_models(self, user, passwd):
+        """Returns a Counter of model identifier to number of devices."""
+        return collections.Counter(
+            self.mobile_devices(user, passwd).values())
+
+    def fetch_device_builds(self, user, passwd):
+        """Returns two dicts, of device id to model identifier and of device
+        id to the OS build it runs. Only the Jamf Pro API lists builds;
+        errors are raised as from urllib2 and json."""
+        devices = {}
+        builds = {}
+
+        def add(page):
+            for device in page.get("results", []):
+                device_id = device.get("mobileDeviceId", device.get("id"))
+                model = (device.get("hardware") or {}).get("modelIdentifier")
+                build = (device.get("general") or {}).get("osBuild")
+                if model and device_id is not None:
+                    device_id = _ascii(unicode(device_id))
+                    devices[device_id] = _ascii(model)
+                    if build:
+                        builds[device_id] = _ascii(build)
+
+        basic = "Basic {}".format(
+            base64.b64encode("{}:{}".format(user, passwd)))
+        self._api_pages(self._api_token(basic), "api/v2/mobile-devices/detail",
+                        add, "&section=GENERAL&section=HARDWARE")
+        return devices, builds
+
+    def mobile_ids(self, user, passwd):
+        """Returns the distinct model identifiers, most common first."""
+        return [model for model, count
+                in self.mobile_models(user, passwd).most_common()]
+
+    def _open(self, url, authorization, data=None):
+        request = urllib2.Request(url, data)
+        request.add_header("Authorization", authorization)
+        request.add_header("Accept", "application/json")
+        return internet.client().open(request)
+
+    def _api_token(self, basic):
+        response = self._open(self.base_url + "api/v1/auth/token", basic,
+                              data="")
+        try:
+            return "Bearer {}".format(json.load(response)["token"])
+        finally:
+            response.close()
+
+    def _api_page(self, bearer, path, page, query=""):
+        url = ("{}{}?page={}&page-size={}&sort=id%3Aasc{}".format(
+            self.base_url, path, page, self.page_size, query))
+        response = self._open(url, bearer)
+        try:
+            return json.load(response)
+        finally:
+            response.close()
+
+    def _api_pages(self, bearer, path, handle, query=""):
+        """Passes every page of a paged Jamf Pro API listing to handle."""
+        first = self._api_page(bearer, path, 0, query)
+        handle(first)
+        total = first.get("totalCount", 0)
+        pages = range(1, (total + self.page_size - 1) // self.page_size)
+        logger.debug("Jamf lists {} devices in {} pages".format(
+            total, len(pages) + 1))
+        if pages:
+            pool = ThreadPool(min(self.workers, len(pages)))
+            try:
+                # Each page is handled and dropped as it arrives
+                for page in pool.imap_unordered(
+                        lambda number: self._api_page(bearer, path, number,
+                                                      query), pages):
+                    handle(page)
+            finally:
+                pool.close()
+                pool.join()
+
+    def _api_devices(self, basic):
+        devices = {}
+
+        def count(page):
+            for device in page.get("results", []):
+                model = device.get("modelIdentifier")
+                if model and device.get("id") is not None:
+                    devices[_ascii(unicode(device["id"]))] = _ascii(model)
+
+        self._api_pages(self._api_token(basic), "api/v2/mobile-devices",
+                        count)
+        return devices
+
+    def _classic_devices(self, basic):
+        request = urllib2.Request(self.jamf_server)
+        request.add_header("Authorization", basic)
+        request.add_header("Accept", "application/xml")
+        response = internet.client().open(request)
+        parser = DeviceListParser()
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+        finally:
+            response.close()
+        return parser.close()
+
+
+class JamfInventory(object):
+    """Local copy of the device ids and models of a Jamf instance.
+
+    Once a copy exists, models() answers from it straight away. If the copy
+    is older than 'max_age' seconds the inventory is fetched again on a
+    background thread and compared with it, so planning never waits on
+    Jamf. wait() returns the models that turned up in that refresh, which
+    were not part of the answer already given.
+
+    With with_builds=True the OS build of each device is kept as well, read
+    from the more detailed Jamf Pro API listing, for os_builds().
+    """
+    def __init__(self, request, path, max_age=INVENTORY_TTL,
+                 with_builds=False):
+        self.request = request
+        self.path = path
+        self.max_age = max_age
+        self.with_builds = with_builds
+        self.devices = None
+        self.builds = {}
+        self.synced = 0
+        self.new_models = []
+        self._thread = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        # A copy made without builds can not answer for them
+        if self.with_builds and "builds" not in data:
+            return
+        self.devices = dict((_ascii(device), _ascii(model))
+                            for device, model in data["devices"].items())
+        self.builds = dict((_ascii(device), _ascii(build))
+                           for device, build in data.get("builds", {}).items())
+        self.synced = data["synced"]
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder, 0o755)
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            data = {"synced": self.synced, "devices": self.devices}
+            if self.with_builds:
+                data["builds"] = self.builds
+            with os.fdopen(fd, "wb") as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.error("Unable to save Jamf inventory: {}".format(e))
+
+    def sync(self, user, passwd):
+        """Fetches the inventory, records what changed and saves it."""
+        if self.with_builds:
+            devices, builds = self.request.fetch_device_builds(user, passwd)
         else:
-            return re.findall(search, jamf_response.read())
+            devices, builds = self.request.fetch_devices(user, passwd), {}
+        old = self.devices or {}
+        changed = [device for device, model in devices.items()
+                   if old.get(device) != model]
+        removed = len(set(old) - set(devices))
+        logger.info("Jamf inventory: {} devices, {} new or changed, {} "
+                    "removed".format(len(devices), len(changed), removed))
+        self.new_models = sorted(set(devices.values()) - set(old.values()))
+        self.devices = devices
+        self.builds = builds
+        self.synced = time.time()
+        self.save()
+
+    def _background_sync(self, user, passwd):
+        try:
+            self.sync(user, passwd)
+        except Exception as e:
+            logger.error("Unable to refresh Jamf inventory: {}".format(e))
+
+    def models(self, user, passwd):
+        """Returns a Counter of model identifier to number of devices."""
+        if self.devices is None:
+            try:
+                self.sync(user, passwd)
+            except (urllib2.URLError, urllib2.HTTPError, ValueError,
+                    expat.ExpatError) as e:
+                logger.error("Can not load models from jamf: {}".format(e))
+                sys.exit(1)
+            self.new_models = []
+        elif time.time() - self.synced > self.max_age:
+            logger.debug("Refreshing Jamf inventory in the background")
+            self._thread = threading.Thread(
+                target=self._background_sync, args=(user, passwd))
+            self._thread.daemon = True
+            self._thread.start()
+        return self.counts()
+
+    def counts(self):
+        """Returns a Counter of model identifier to number of devices in the
+        local copy."""
+        return collections.Counter((self.devices or {}).values())
+
+    def os_builds(self):
+        """Returns a dict of model identifier to the set of OS builds its
+        devices run, from the local copy."""
+        builds = {}
+        for device, build in self.builds.items():
+            model = (self.devices or {}).get(device)
+            if model:
+                builds.setdefault(model, set()).add(build)
+        return builds
+
+    def wait(self):
+        """Waits for a background refresh to finish. Returns the models it
+        found that were not in the copy models() answered from."""
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return self.new_models
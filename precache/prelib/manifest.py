@@ -0,0 +1,98 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from precache.prelib import partial
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".precache-manifest.json"
+
+
+class StoreManifest(object):
+    """Index of the files saved in an output folder.
+
+    For each file it records the size and mtime it had when it was saved,
+    the URL it came from, its verified sha1, its sha256 and the models it
+    serves, as one IPSW can be shared by many models. A file whose size and mtime still
+    match was not touched since, so it can be trusted without reading it
+    again. The index is kept in the folder itself.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.files = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                self.files = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.files = {}
+
+    def save(self):
+        with self._lock:
+            if not os.path.isdir(self.folder):
+                return
+            fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    json.dump(self.files, f, indent=1, sort_keys=True)
+                os.rename(tmp, self.path)
+            except (IOError, OSError) as e:
+                logger.error("Unable to save manifest %s: %s" % (
+                    self.path, e))
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+
+    def record(self, filename, url, sha1, models=(), sha256=None):
+        """Records filename, as it is on disk now, with its URL, digests and
+        the models it serves."""
+        stat = os.stat(os.path.join(self.folder, filename))
+        with self._lock:
+            self.files[filename] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "url": url,
+                "sha1": sha1,
+                "sha256": sha256,
+                "models": sorted(set(models)),
+            }
+
+    def add_models(self, filename, models):
+        """Adds models to those filename serves. Returns True if any were
+        new."""
+        with self._lock:
+            entry = self.files.get(filename)
+            if entry is None:
+                return False
+            known = set(entry.get("models", []))
+            if known.issuperset(models):
+                return False
+            entry["models"] = sorted(known.union(models))
+            return True
+
+    def current(self, filename, url, sha1=None):
+        """True if filename is recorded as coming from url, has not changed
+        on disk since, and matches sha1 when one is given."""
+        with self._lock:
+            entry = self.files.get(filename)
+        if not entry or not partial.same_asset(entry["url"], url):
+            return False
+        if sha1 and entry["sha1"] != sha1.lower():
+            return False
+        try:
+            stat = os.stat(os.path.join(self.folder, filename))
+        except OSError:
+            return False
+        return (stat.st_size == entry["size"] and
+                stat.st_mtime == entry["mtime"])
@@ -0,0 +1,94 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from precache.prelib.probe import MISSING_STATUSES
+from precache.prelib.probe import Probe
+
+logger = logging.getLogger(__name__)
+
+NEGATIVE_TTL = 86400
+
+
+class MetadataCache(object):
+    """Persistent store of probe results keyed by URL.
+
+    Software update URLs are immutable, so a package that was found (and the
+    version read from its SMD) is remembered for good. Missing packages are
+    remembered for 'negative_ttl' seconds, since they may still be published.
+    Only a 404 or 410 counts as missing; hosts that could not be reached or
+    answered with any other error are never remembered.
+    """
+    def __init__(self, path, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                self._entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+
+    def get(self, url):
+        """Returns the stored Probe for url, or None if there is none or it
+        has expired."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if not entry:
+            return None
+        if not entry["exists"] and (
+                entry["status"] not in MISSING_STATUSES or
+                time.time() - entry["fetched"] > self.negative_ttl):
+            return None
+        version = entry["version"]
+        if version:
+            # json gives back unicode, plistlib gives plain strings
+            try:
+                version = version.encode("ascii")
+            except UnicodeError:
+                pass
+        return Probe(url, entry["exists"], entry["status"], entry["size"],
+                     version)
+
+    def put(self, probe):
+        if probe.status is None or (
+                not probe.exists and probe.status not in MISSING_STATUSES):
+            return
+        with self._lock:
+            self._entries[probe.url] = {
+                "exists": probe.exists,
+                "status": probe.status,
+                "size": probe.size,
+                "version": probe.version,
+                "fetched": time.time(),
+            }
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            folder = os.path.dirname(self.path)
+            try:
+                if not os.path.isdir(folder):
+                    os.makedirs(folder, 0o755)
+                fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    json.dump(self._entries, f)
+                os.rename(tmp, self.path)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                logger.error("Unable to save metadata cache: %s" % e)
@@ -0,0 +1,360 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# Files are only split when every segment would be at least this big.
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# Segment progress is written to the sidecar after this many bytes.
+SAVE_INTERVAL = 64 * 1024 * 1024
+# Digests worked out for every saved file
+DIGESTS = ("sha1", "sha256")
+
+
+class ChecksumError(ValueError):
+    """A finished download did not match its expected digest."""
+
+
+class ResumeError(IOError):
+    """The server answered a resume with a range that does not continue the
+    part file. The part file has been discarded, so the file has to be
+    requested again in full."""
+
+
+def new_hashers():
+    """Returns a dict of algorithm to a fresh hash object, for each digest
+    recorded for a saved file."""
+    return dict((algorithm, hashlib.new(algorithm)) for algorithm in DIGESTS)
+
+
+def file_hashers(path, limit=None, blocksize=1048576):
+    """Returns new_hashers() fed with the first limit bytes of path, or all
+    of it."""
+    hashers = new_hashers()
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            size = blocksize if remaining is None else min(blocksize,
+                                                           remaining)
+            data = f.read(size)
+            if not data:
+                break
+            for hasher in hashers.values():
+                hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hashers
+
+
+def write_digest(path, digest, algorithm="sha1"):
+    """Records digest next to path as '<path>.<algorithm>', in shasum
+    format."""
+    with open("%s.%s" % (path, algorithm), "wb") as f:
+        f.write("%s  %s\n" % (digest, os.path.basename(path)))
+
+
+def same_asset(url, other):
+    """True if both URLs name the same file. Only the path and query are
+    compared, so a caching server that moved to another port still
+    matches."""
+    split_url = urlparse.urlsplit(url)
+    split_other = urlparse.urlsplit(other)
+    return (split_url.path, split_url.query) == (
+        split_other.path, split_other.query)
+
+
+class PartialDownload(object):
+    """A download kept in '<path>.part' until it is complete.
+
+    Next to the part file is a '<path>.part.json' sidecar with the URL, the
+    ETag and Last-Modified it was served with and its full length. A later
+    run resumes from the end of the part file with a Range request, guarded
+    by If-Range so a file that has changed on the server is sent whole. When
+    every byte has arrived the part file is renamed onto path.
+
+    The sha1 and sha256 of the file are worked out from the data as it is
+    written, so they are known without reading the file back. Only the part already on
+    disk when a download is resumed has to be read again.
+    """
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+        self.part_path = path + ".part"
+        self.meta_path = self.part_path + ".json"
+        self.etag = None
+        self.last_modified = None
+        self.length = None
+        self.offset = 0
+        self.segments = None
+        self.sha1 = None
+        self.sha256 = None
+        self._hashers = None
+        self._file = None
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.meta_path, "rb") as f:
+                meta = json.load(f)
+            offset = os.path.getsize(self.part_path)
+        except (IOError, OSError, ValueError):
+            return
+        if not same_asset(meta.get("url", ""), self.url):
+            logger.debug("Part file is for another URL: %s" % self.part_path)
+            return
+        length = meta.get("length")
+        if not length or offset > length:
+            return
+        self.etag = meta.get("etag")
+        self.last_modified = meta.get("last_modified")
+        self.length = length
+        if meta.get("segments"):
+            # A segmented part file is full size with holes in it, its size
+            # says nothing about how much has arrived.
+            self.segments = meta["segments"]
+            self.offset = sum(done - start
+                              for start, end, done in self.segments)
+        else:
+            self.offset = offset
+
+    def _save(self):
+        folder = os.path.dirname(self.meta_path)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                json.dump({"url": self.url,
+                           "etag": self.etag,
+                           "last_modified": self.last_modified,
+                           "length": self.length,
+                           "segments": self.segments}, f)
+            os.rename(tmp, self.meta_path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    @property
+    def finished(self):
+        """True if the part file already holds every byte."""
+        return bool(self.length) and self.offset == self.length
+
+    def request_headers(self):
+        """Headers that ask for the rest of the file, or {} to fetch it
+        whole."""
+        validator = self.etag or self.last_modified
+        if not self.offset or not validator or self.segments:
+            return {}
+        return {"Range": "bytes=%d-" % self.offset, "If-Range": validator}
+
+    def start(self, response):
+        """Opens the part file for the body of response, appending to it if
+        the server sent the missing range and starting over if it sent the
+        whole file. Returns the offset the body starts at. Any other range
+        discards the part file and raises ResumeError."""
+        info = response.info()
+        content_range = CONTENT_RANGE.match(
+            info.getheader("Content-Range") or "")
+        if response.getcode() == 206:
+            if (content_range and self.offset and
+                    int(content_range.group(1)) == self.offset and
+                    content_range.group(3) == str(self.length)):
+                logger.info("Resuming %s at byte %d of %d" % (
+                    self.path, self.offset, self.length))
+                self._hashers = file_hashers(self.part_path, self.offset)
+                self._file = open(self.part_path, "ab")
+                return self.offset
+            # Only part of the file, and not the part that was missing
+            message = "%s: got range %r resuming at byte %d" % (
+                self.path, info.getheader("Content-Range"), self.offset)
+            self.discard()
+            raise ResumeError(message)
+
+        if self.offset:
+            logger.info("Unable to resume %s, starting over" % (self.path))
+        length = info.getheader("Content-Length")
+        self.length = int(length) if length and length.isdigit() else None
+        self.etag = info.getheader("ETag")
+        self.last_modified = info.getheader("Last-Modified")
+        self.offset = 0
+        self.segments = None
+        self._hashers = new_hashers()
+        self._file = open(self.part_path, "wb")
+        self._save()
+        return 0
+
+    def write(self, data):
+        self._file.write(data)
+        for hasher in self._hashers.values():
+            hasher.update(data)
+        self.offset += len(data)
+
+    def close(self):
+        """Closes the part file, leaving it to be resumed later."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _set_digests(self, hashers):
+        self.sha1 = hashers["sha1"].hexdigest()
+        self.sha256 = hashers["sha256"].hexdigest()
+
+    def _accept(self, expected):
+        """Checks the sha1 against expected, then renames the part file onto
+        path and records the sha1 next to it. A part file that does not
+        match is removed and ChecksumError raised."""
+        if expected and self.sha1 != expected.lower():
+            self.discard()
+            raise ChecksumError("%s: expected sha1 %s, got %s" % (
+                self.path, expected, self.sha1))
+        os.rename(self.part_path, self.path)
+        if os.path.exists(self.meta_path):
+            os.unlink(self.meta_path)
+        write_digest(self.path, self.sha1)
+        write_digest(self.path, self.sha256, "sha256")
+
+    def discard(self):
+        """Removes the part file and its sidecar, so the next request is for
+        the whole file."""
+        self.close()
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.etag = None
+        self.last_modified = None
+        self.length = None
+        self.offset = 0
+        self.segments = None
+
+    def finish(self, expected=None):
+        """Called once the body has ended. Accepts a complete part file (see
+        _accept) and returns True; an incomplete one is kept to be resumed
+        and False returned."""
+        self.close()
+        if self.length is not None and self.offset != self.length:
+            logger.info("Kept %d of %d bytes of %s to resume later" % (
+                self.offset, self.length, self.path))
+            return False
+        # Nothing was streamed when the part file was already complete
+        self._set_digests(self._hashers or file_hashers(self.part_path))
+        self._accept(expected)
+        return True
+
+
+class SegmentedDownload(PartialDownload):
+    """A PartialDownload fetched as several byte ranges at once.
+
+    The part file is created at its full size up front (sparse where the
+    filesystem allows) and each segment is written in place. The sidecar
+    lists every segment as [start, end, done], 'done' being the next byte
+    still to fetch. Segments are written unbuffered and the sidecar is
+    saved every SAVE_INTERVAL bytes, so a later run fetches only what is
+    missing. Segments arrive out of order, so the digests are worked out by
+    reading the file once it is complete. A single stream part file left by an
+    earlier run is picked up as an already fetched first segment.
+    """
+    def plan(self, length, etag=None, last_modified=None, count=4,
+             min_size=None):
+        """Lays out the segments for a file of length bytes, keeping the
+        progress of an earlier run if the file has not changed. Returns
+        False if the file is too small to be worth splitting."""
+        if (self.length != length or
+                (etag or last_modified) != (self.etag or self.last_modified)):
+            self.offset = 0
+            self.segments = None
+        if self.segments:
+            return True
+
+        # Bytes already fetched by a single stream, if any
+        first = self.offset
+        remaining = length - first
+        count = min(count, remaining // (min_size or MIN_SEGMENT_SIZE))
+        if count < 2:
+            return False
+        size = remaining // count
+        segments = []
+        if first:
+            segments.append([0, first - 1, first])
+        for index in range(count):
+            start = first + index * size
+            end = length - 1 if index == count - 1 else start + size - 1
+            segments.append([start, end, start])
+
+        self.length = length
+        self.etag = etag
+        self.last_modified = last_modified
+        self.segments = segments
+        with open(self.part_path, "ab") as f:
+            f.truncate(length)
+        self._save()
+        return True
+
+    def pending(self):
+        """Indexes of the segments that still have bytes to fetch."""
+        return [index for index, (start, end, done)
+                in enumerate(self.segments) if done <= end]
+
+    def segment_headers(self, index):
+        start, end, done = self.segments[index]
+        headers = {"Range": "bytes=%d-%d" % (done, end)}
+        validator = self.etag or self.last_modified
+        if validator:
+            headers["If-Range"] = validator
+        return headers
+
+    def check_segment(self, index, response):
+        """True if response carries exactly the range asked for."""
+        start, end, done = self.segments[index]
+        content_range = CONTENT_RANGE.match(
+            response.info().getheader("Content-Range") or "")
+        return (response.getcode() == 206 and content_range is not None and
+                int(content_range.group(1)) == done and
+                content_range.group(3) == str(self.length))
+
+    def open_segment(self, index):
+        """Opens the part file at the next byte of segment index. Writes are
+        unbuffered, so whatever advance() has recorded is on disk."""
+        f = open(self.part_path, "r+b", 0)
+        f.seek(self.segments[index][2])
+        return f
+
+    def advance(self, index, received):
+        """Records that received more bytes of segment index were written,
+        saving the sidecar every SAVE_INTERVAL bytes."""
+        with self._lock:
+            self.segments[index][2] += received
+            self.offset += received
+            self._unsaved += received
+            if self._unsaved >= SAVE_INTERVAL:
+                self._save()
+                self._unsaved = 0
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def finish(self, expected=None):
+        """Accepts the part file if every segment is done and returns True,
+        otherwise keeps it to be resumed."""
+        self.save()
+        if self.pending():
+            logger.info("Kept %d of %d bytes of %s to resume later" % (
+                self.offset, self.length, self.path))
+            return False
+        self._set_digests(file_hashers(self.part_path))
+        self._accept(expected)
+        return True
@@ -0,0 +1,124 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import base64
+import datetime
+import logging
+import plistlib
+from xml.parsers import expat
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+
+class PlistStreamParser(object):
+    """Incremental plist parser built on expat.
+
+    Bytes are fed in as they arrive. Every child of the container found at
+    'path' (a tuple of dict keys from the root, i.e. ("Products",)) is handed
+    to callback(key, value) as soon as it is complete and is not kept, so
+    memory is bounded by the largest single entry rather than the whole
+    document. For arrays the key is the index of the entry.
+    """
+    def __init__(self, path, callback):
+        self.path = tuple(path)
+        self.callback = callback
+        self.root = None
+        # Frames of [container, path to container, current key, count]
+        self._stack = []
+        self._data = []
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        """Finishes parsing. Returns the document with the streamed entries
+        left out."""
+        self._parser.Parse("", True)
+        return self.root
+
+    def _chars(self, data):
+        self._data.append(data)
+
+    def _text(self):
+        data = "".join(self._data)
+        self._data = []
+        # Match plistlib, which returns plain strings where it can.
+        try:
+            return data.encode("ascii")
+        except UnicodeError:
+            return data
+
+    def _start(self, name, attrs):
+        self._data = []
+        if name in ("dict", "array"):
+            if self._stack:
+                container, path, key, count = self._stack[-1]
+                path = path + (key if isinstance(container, dict) else count,)
+            else:
+                path = ()
+            self._stack.append([{} if name == "dict" else [], path, None, 0])
+
+    def _end(self, name):
+        if name == "key":
+            self._stack[-1][2] = self._text()
+            return
+        if name == "plist":
+            return
+        if name in ("dict", "array"):
+            value = self._stack.pop()[0]
+        else:
+            value = self._scalar(name, self._text())
+        self._add(value)
+
+    def _scalar(self, name, text):
+        if name == "string":
+            return text
+        if name == "integer":
+            return int(text)
+        if name == "real":
+            return float(text)
+        if name == "true":
+            return True
+        if name == "false":
+            return False
+        if name == "date":
+            return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%SZ")
+        if name == "data":
+            return plistlib.Data(base64.b64decode(text))
+        logger.debug("Unknown plist element: %s" % name)
+        return text
+
+    def _add(self, value):
+        if not self._stack:
+            self.root = value
+            return
+        frame = self._stack[-1]
+        container, path, key, count = frame
+        if path == self.path:
+            self.callback(key if isinstance(container, dict) else count, value)
+        elif isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
+        frame[3] = count + 1
+
+
+def parse_stream(fileobj, path, callback, chunk_size=CHUNK_SIZE):
+    """Reads fileobj in chunks, passing every entry under path to callback as
+    it is parsed. Returns the rest of the document."""
+    parser = PlistStreamParser(path, callback)
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
@@ -0,0 +1,237 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import collections
+import logging
+import plistlib
+import re
+import socket
+import threading
+import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
+from xml.parsers.expat import ExpatError
+
+from precache.prelib import scheduler
+
+logger = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 10
+# Answers that mean a URL does not exist, rather than that the server could
+# not say
+MISSING_STATUSES = (404, 410)
+
+# Result of probing a single URL. status is None when the host could not be
+# reached or gave no definite answer, as opposed to reporting it missing.
+Probe = collections.namedtuple(
+    "Probe", ["url", "exists", "status", "size", "version"])
+
+# Whether the caching server already holds an asset, and its size if known.
+CACHED = "cached"
+UNCACHED = "uncached"
+MISSING = "missing"
+CacheStatus = collections.namedtuple("CacheStatus", ["url", "state", "size"])
+
+
+class Prober(object):
+    """Answers "does this exist, how big is it, what version is it" for a
+    batch of URLs without downloading them.
+
+    Packages are checked with HEAD, falling back to a single byte Range GET
+    for servers that refuse HEAD. SMD files are small, so they are fetched
+    whole and their CFBundleShortVersionString read. Requests run on a pool
+    of 'workers' threads, with at most 'per_host' in flight to any one host.
+    Given a metadata cache, URLs already resolved on an earlier run are
+    answered from it without touching the network. Given a HostLimiter,
+    requests wait on its rate for the host and a 429 or 503 is retried up to
+    'max_retries' times after backing off.
+
+    cache_status() asks the caching server for the first byte of each asset
+    to find out whether it is already cached, without transferring it.
+    """
+    def __init__(self, workers=8, per_host=4, headers=None, opener=None,
+                 timeout=PROBE_TIMEOUT, cache=None, limiter=None,
+                 max_retries=0):
+        self.cache = cache
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.workers = workers
+        self.per_host = per_host
+        self.headers = headers or {}
+        self.opener = opener or urllib2.build_opener()
+        self.timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def _open(self, url, method=None, headers=None):
+        request = urllib2.Request(url, headers=self.headers)
+        for key, value in (headers or {}).items():
+            request.add_header(key, value)
+        if method:
+            request.get_method = lambda: method
+        return self.opener.open(request, timeout=self.timeout)
+
+    def _size(self, response):
+        info = response.info()
+        content_range = info.getheader("Content-Range")
+        if content_range and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1].strip()
+            return int(total) if total.isdigit() else None
+        length = info.getheader("Content-Length")
+        return int(length) if length and length.strip().isdigit() else None
+
+    def _head(self, url):
+        try:
+            response = self._open(url, method="HEAD")
+        except urllib2.HTTPError as e:
+            if e.code not in (403, 405, 501):
+                raise
+            response = self._open(url, headers={"Range": "bytes=0-0"})
+        try:
+            return Probe(url, True, response.getcode(), self._size(response),
+                         None)
+        finally:
+            response.close()
+
+    def _smd(self, url):
+        response = self._open(url)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        try:
+            version = plistlib.readPlistFromString(body).get(
+                "CFBundleShortVersionString")
+        except ExpatError:
+            version = None
+        return Probe(url, True, response.getcode(), len(body), version)
+
+    def _limited(self, func, url):
+        host = scheduler.host_key(url)
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                self.limiter.acquire(host)
+            try:
+                result = func(url)
+            except urllib2.HTTPError as e:
+                if (self.limiter and e.code in (429, 503) and
+                        attempt < self.max_retries):
+                    delay = self.limiter.backoff(
+                        host, e.info().getheader("Retry-After"))
+                    logger.debug("Probe %s: %s, retrying in %0.1fs" % (
+                        url, e.code, delay))
+                    continue
+                raise
+            if self.limiter:
+                self.limiter.success(host)
+            return result
+
+    def _probe(self, target):
+        url, kind = target
+        with self._host_slot(url):
+            try:
+                if kind == "smd":
+                    return self._limited(self._smd, url)
+                return self._limited(self._head, url)
+            except urllib2.HTTPError as e:
+                logger.debug("Probe %s: %s" % (url, e))
+                # Any other error says nothing about whether url exists
+                status = e.code if e.code in MISSING_STATUSES else None
+                return Probe(url, False, status, None, None)
+            except (urllib2.URLError, socket.error) as e:
+                logger.debug("Probe %s: %s" % (url, e))
+                return Probe(url, False, None, None, None)
+
+    def _cache_status(self, target):
+        url, headers = target
+        headers = dict(headers or {})
+        headers["Range"] = "bytes=0-0"
+        with self._host_slot(url):
+            try:
+                response = self._limited(
+                    lambda url: self._open(url, headers=headers), url)
+            except urllib2.HTTPError as e:
+                logger.debug("Cache status %s: %s" % (url, e))
+                state = MISSING if e.code in MISSING_STATUSES else UNCACHED
+                return CacheStatus(url, state, None)
+            except (urllib2.URLError, socket.error) as e:
+                logger.debug("Cache status %s: %s" % (url, e))
+                return CacheStatus(url, UNCACHED, None)
+        try:
+            # Only read the body of a ranged reply, a server that ignored
+            # the Range header is sending the whole asset.
+            if response.getcode() == 206:
+                response.read()
+            # The caching server leaves out Content-Type when it serves an
+            # asset from its own store.
+            if response.info().getheader("Content-Type") is None:
+                state = CACHED
+            else:
+                state = UNCACHED
+            return CacheStatus(url, state, self._size(response))
+        finally:
+            response.close()
+
+    def _map(self, func, items):
+        pool = ThreadPool(max(1, min(self.workers, len(items))))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def cache_status(self, targets):
+        """Checks (url, headers) pairs against the caching server. Returns a
+        dict of url to CacheStatus. Results are never stored, since assets
+        come and go from the caching server."""
+        pending = collections.OrderedDict()
+        for url, headers in targets:
+            pending.setdefault(url, (url, headers))
+        if not pending:
+            return {}
+        logger.debug("Checking cache status of %d URLs" % (len(pending)))
+        results = self._map(self._cache_status, pending.values())
+        return dict((result.url, result) for result in results)
+
+    def probe(self, targets):
+        """Probes (url, kind) pairs, kind being "smd" or "head". Returns a
+        dict of url to Probe."""
+        probes = {}
+        pending = []
+        for target in collections.OrderedDict.fromkeys(targets):
+            cached = self.cache.get(target[0]) if self.cache else None
+            if cached:
+                probes[cached.url] = cached
+            else:
+                pending.append(target)
+        logger.debug("Probing %d URLs, %d answered from cache" %
+                     (len(pending), len(probes)))
+        if not pending:
+            return probes
+
+        for result in self._map(self._probe, pending):
+            probes[result.url] = result
+            if self.cache:
+                self.cache.put(result)
+        if self.cache:
+            self.cache.save()
+        return probes
+
+
+def smd_version(probe, fallback):
+    """Returns the version from a probed SMD, or the dotted number found in
+    fallback when there is none or it is not numeric."""
+    version = probe.version if probe else None
+    if not version or re.search("[a-zA-Z]", version):
+        found = re.findall(r"[\d.]+", fallback)
+        version = found[0] if found else ""
+    return version.rstrip(".")
@@ -0,0 +1,101 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import email.utils
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after(value):
+    """Returns the number of seconds asked for by a Retry-After header, which
+    is either a number of seconds or an HTTP date. None if not usable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed:
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+    return None
+
+
+class _Bucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.hold_until = 0
+        self.successes = 0
+
+
+class HostLimiter(object):
+    """Token bucket rate limiter keyed per host.
+
+    Each host starts at 'rate' requests a second with bursts of up to
+    'burst'. When a host answers 429 or 503 its rate is halved (down to
+    'min_rate') and, if the server sent Retry-After, nothing more is sent to
+    it until then. After 'recover_after' successes in a row the rate is
+    doubled again, up to the starting rate.
+    """
+    def __init__(self, rate=10.0, burst=10, min_rate=0.1, recover_after=20):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recover_after = recover_after
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            self._buckets[host] = _Bucket(self.rate, self.burst)
+        return self._buckets[host]
+
+    def acquire(self, host):
+        """Blocks until a request may be sent to host."""
+        while True:
+            with self._lock:
+                bucket = self._bucket(host)
+                now = time.time()
+                bucket.tokens = min(
+                    self.burst,
+                    bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                wait = bucket.hold_until - now
+                if wait <= 0:
+                    if bucket.tokens >= 1:
+                        bucket.tokens -= 1
+                        return
+                    wait = (1 - bucket.tokens) / bucket.rate
+            time.sleep(wait)
+
+    def success(self, host):
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.successes += 1
+            if (bucket.successes >= self.recover_after and
+                    bucket.rate < self.rate):
+                bucket.rate = min(self.rate, bucket.rate * 2)
+                bucket.successes = 0
+                logger.debug("Speeding up %s to %0.2f/s" % (host, bucket.rate))
+
+    def backoff(self, host, retry_after_header=None):
+        """Slows host down after a 429 or 503. Returns the number of seconds
+        before the next request to it will be let through."""
+        delay = retry_after(retry_after_header)
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.successes = 0
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket.tokens = 0
+            if delay is None:
+                delay = 1 / bucket.rate
+            bucket.hold_until = max(bucket.hold_until, time.time() + delay)
+        logger.debug("Backing off %s for %0.1fs, now %0.2f/s" % (
+            host, delay, bucket.rate))
+        return delay
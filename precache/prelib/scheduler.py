@@ -0,0 +1,111 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import bisect
+import itertools
+import logging
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def host_key(url):
+    """Returns the origin host of url. Caching server URLs carry the origin
+    in their 'source' query parameter."""
+    split_url = urlparse.urlsplit(url)
+    source = urlparse.parse_qs(split_url.query).get("source")
+    return source[0] if source else split_url.netloc
+
+
+class DownloadScheduler(object):
+    """Runs a queue of Asset jobs on a bounded pool of worker threads.
+
+    No more than 'per_host' jobs run against the same origin host at once;
+    a free worker takes the first queued job whose host has room, so one
+    busy host does not hold up the others. Each job is passed to
+    worker(asset). A job that raises is logged and does not stop the rest.
+
+    Jobs are queued by priority, highest first, and in the order they were
+    submitted when the priorities are equal.
+    """
+    def __init__(self, worker, workers=4, per_host=2):
+        self.worker = worker
+        self.workers = workers
+        self.per_host = per_host
+        self.pending = []
+        self.failed = []
+        # (-priority, sequence) of each pending job, kept sorted
+        self._keys = []
+        self._sequence = itertools.count()
+        self.completed = 0
+        self._queued = set()
+        self._active = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, asset, priority=0):
+        """Queues asset ahead of any job with a lower priority. Returns False
+        if it is already queued."""
+        with self._cond:
+            if asset in self._queued:
+                return False
+            self._queued.add(asset)
+            key = (-priority, next(self._sequence))
+            index = bisect.bisect(self._keys, key)
+            self._keys.insert(index, key)
+            self.pending.insert(index, asset)
+            self._cond.notify()
+            return True
+
+    def _next_job(self):
+        with self._cond:
+            while self.pending:
+                for index, asset in enumerate(self.pending):
+                    host = host_key(asset.url)
+                    if self._active.get(host, 0) < self.per_host:
+                        self._active[host] = self._active.get(host, 0) + 1
+                        del self._keys[index]
+                        return self.pending.pop(index), host
+                self._cond.wait()
+            return None, None
+
+    def _done(self, host):
+        with self._cond:
+            self._active[host] -= 1
+            self.completed += 1
+            self._cond.notify_all()
+
+    def _run_worker(self):
+        while True:
+            asset, host = self._next_job()
+            if asset is None:
+                return
+            try:
+                self.worker(asset)
+            except Exception as e:
+                logger.error("Failed %s (%s): %s" % (
+                    asset.model, asset.version, e))
+                self.failed.append(asset)
+            finally:
+                self._done(host)
+
+    def run(self):
+        """Runs every queued job and returns once they have all finished."""
+        threads = []
+        for _ in range(max(1, min(self.workers, len(self.pending)))):
+            thread = threading.Thread(target=self._run_worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Join with a timeout so that a KeyboardInterrupt still gets through.
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+        logger.debug("Scheduler finished: %d done, %d failed" % (
+            self.completed, len(self.failed)))
+        return self.failed
@@ -0,0 +1,81 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import cPickle
+import gzip
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TTL = 3600
+# Bumped whenever the shape of the entries changes: 2 added the
+# PrerequisiteBuild to the meta, 3 an entry for each supported device
+SNAPSHOT_FORMAT = 3
+
+
+class CatalogSnapshot(object):
+    """Compact on-disk copy of the entries each feed source contributed to
+    the asset catalog, with the time each source was fetched.
+
+    Entries are stored as the plain tuples the feeds produced, with the
+    origin URL, so a snapshot stays valid when the caching server changes.
+    OTA entries are (model, version, url, group, meta), meta being the dict
+    of details kept for the URL, such as its sha1 and PrerequisiteBuild.
+    Other feeds give (model, version, url, group).
+    """
+    def __init__(self, path, ttl=SNAPSHOT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.sources = {}
+        self.load()
+
+    def load(self):
+        try:
+            with gzip.open(self.path, "rb") as f:
+                data = cPickle.load(f)
+        except (IOError, OSError, EOFError, ValueError,
+                cPickle.UnpicklingError):
+            return
+        if data.get("format") != SNAPSHOT_FORMAT:
+            logger.debug("Ignoring snapshot in an old format: %s" % self.path)
+            return
+        self.sources = data["sources"]
+
+    def age(self, source):
+        """Seconds since source was fetched, or None if it is not stored."""
+        if source not in self.sources:
+            return None
+        return time.time() - self.sources[source]["fetched"]
+
+    def entries(self, source, offline=False):
+        """Returns the stored entries for source if it is younger than the
+        TTL, or of any age when offline. Otherwise returns None."""
+        age = self.age(source)
+        if age is None or (not offline and age > self.ttl):
+            return None
+        return self.sources[source]["entries"]
+
+    def update(self, source, entries):
+        self.sources[source] = {
+            "fetched": time.time(),
+            "entries": [tuple(entry) for entry in entries],
+        }
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder, 0o755)
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            os.close(fd)
+            with gzip.open(tmp, "wb") as f:
+                cPickle.dump({"format": SNAPSHOT_FORMAT,
+                              "sources": self.sources}, f, 2)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.error("Unable to save catalog snapshot: %s" % e)
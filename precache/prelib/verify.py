@@ -0,0 +1,129 @@
+#!/System/Library/Frameworks/Python.framework/Versions/Current/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Glynn Lane (primalcurve)
+
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from precache.prelib import manifest
+
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = ("sha1", "sha256")
+BLOCK_SIZE = 8 * 1024 * 1024
+# Files in a store folder that hold details about the others
+METADATA_SUFFIXES = (".sha1", ".sha256", ".part", ".part.json", ".tmp")
+
+# Outcome of checking one file. expected is None when no digest for it was
+# found, actual is None when it could not be read.
+Result = collections.namedtuple(
+    "Result", ["filename", "size", "expected", "actual", "seconds"])
+
+
+def hash_file(path, algorithm="sha1", blocksize=BLOCK_SIZE):
+    """Returns the hex digest of path. The file is memory mapped and hashed
+    a block at a time without copying it; hashlib lets go of the GIL while
+    it works, so several files can be hashed at once on threads."""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return hasher.hexdigest()
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError, OverflowError):
+            # Large reads into one reused buffer instead
+            block = bytearray(blocksize)
+            view = memoryview(block)
+            while True:
+                read = f.readinto(block)
+                if not read:
+                    break
+                hasher.update(view[:read])
+            return hasher.hexdigest()
+        try:
+            for offset in xrange(0, size, blocksize):
+                hasher.update(buffer(mapped, offset, blocksize))
+        finally:
+            mapped.close()
+    return hasher.hexdigest()
+
+
+def expected_digests(folder, algorithm="sha1"):
+    """Returns a dict of filename to the digest published for it, from the
+    manifest and the '<file>.<algorithm>' files next to it."""
+    digests = {}
+    store = manifest.StoreManifest(folder)
+    for filename, entry in store.files.items():
+        if entry.get(algorithm):
+            digests[filename] = entry[algorithm]
+    suffix = "." + algorithm
+    for name in os.listdir(folder):
+        if not name.endswith(suffix):
+            continue
+        try:
+            with open(os.path.join(folder, name), "rb") as f:
+                digest = f.read().split()[0].lower()
+        except (IOError, IndexError):
+            continue
+        digests[name[:-len(suffix)]] = digest
+    return digests
+
+
+def store_files(folder):
+    """Names of the files in folder that hold saved assets."""
+    return sorted(
+        name for name in os.listdir(folder)
+        if os.path.isfile(os.path.join(folder, name)) and
+        name != manifest.MANIFEST_NAME and
+        not name.endswith(METADATA_SUFFIXES))
+
+
+class StoreVerifier(object):
+    """Hashes every file in a store folder on a pool of 'workers' threads
+    and compares each with its published digest."""
+    def __init__(self, folder, algorithm="sha1", workers=4,
+                 blocksize=BLOCK_SIZE):
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unsupported algorithm: %s" % algorithm)
+        self.folder = folder
+        self.algorithm = algorithm
+        self.workers = workers
+        self.blocksize = blocksize
+
+    def _check(self, job):
+        filename, expected = job
+        path = os.path.join(self.folder, filename)
+        start = time.time()
+        try:
+            size = os.path.getsize(path)
+            actual = hash_file(path, self.algorithm, self.blocksize)
+        except (IOError, OSError) as e:
+            logger.error("Unable to read %s: %s" % (path, e))
+            size, actual = 0, None
+        return Result(filename, size, expected, actual, time.time() - start)
+
+    def run(self, callback=None):
+        """Checks every file, calling callback(result) as each finishes.
+        Returns the list of results and the seconds taken."""
+        digests = expected_digests(self.folder, self.algorithm)
+        jobs = [(filename, digests.get(filename))
+                for filename in store_files(self.folder)]
+        results = []
+        start = time.time()
+        pool = ThreadPool(max(1, min(self.workers, len(jobs))))
+        try:
+            for result in pool.imap_unordered(self._check, jobs):
+                results.append(result)
+                if callback:
+                    callback(result)
+        finally:
+            pool.close()
+            pool.join()
+        return results, time.time() - start
@@ -14,6 +14,7 @@ your fix.
 
 import argparse
 import base64
+import os
 import sys
 from precache import precache
 
@@ -82,6 +83,13 @@ def main():
                         help="Cache IPSW based on group",
                         required=False)
 
+    parser.add_argument("--cache-dir",
+                        type=str,
+                        dest="cache_dir",
+                        metavar="file path",
+                        help="Path to keep cached feeds and metadata in.",
+                        required=False)
+
     parser.add_argument("-cs", "--cache-server",
                         type=str,
                         nargs=1,
@@ -151,6 +159,55 @@ def main():
                         help="Jamf server password",
                         required=False)
 
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        dest="chunk_size",
+                        default=1048576,
+                        metavar="bytes",
+                        help="Size of the buffer each download is read "
+                             "into.",
+                        required=False)
+
+    parser.add_argument("--fleet-builds",
+                        type=str,
+                        dest="fleet_builds",
+                        metavar="FILE",
+                        help="Only cache delta OTAs that install over an OS "
+                             "build the fleet runs, listed in FILE as JSON "
+                             "or 'model build' lines. Use 'jamf' to read "
+                             "the builds from the Jamf server.",
+                        required=False)
+
+    parser.add_argument("--negative-ttl",
+                        type=int,
+                        dest="negative_ttl",
+                        default=86400,
+                        metavar="seconds",
+                        help="How long to remember that an update package "
+                             "is missing.",
+                        required=False)
+
+    parser.add_argument("--offline",
+                        action="store_true",
+                        dest="offline",
+                        help="Plan and list from the catalog snapshot only, "
+                             "without fetching any feeds.",
+                        required=False)
+
+    parser.add_argument("--per-host",
+                        type=int,
+                        dest="per_host",
+                        default=2,
+                        metavar="count",
+                        help="Most downloads to run at once from one host.",
+                        required=False)
+
+    parser.add_argument("--proxy",
+                        dest="proxy",
+                        metavar="host:port",
+                        help="HTTP proxy to send all requests through.",
+                        required=False)
+
     parser.add_argument("-o", "--output",
                         type=str,
                         nargs=1,
@@ -159,12 +216,54 @@ def main():
                         help="Path to save IPSW files to.",
                         required=False)
 
+    parser.add_argument("--segments",
+                        type=int,
+                        dest="segments",
+                        default=1,
+                        metavar="N",
+                        help="Fetch large IPSW files as N byte ranges at "
+                             "once.",
+                        required=False)
+
+    parser.add_argument("--snapshot-ttl",
+                        type=int,
+                        dest="snapshot_ttl",
+                        default=3600,
+                        metavar="seconds",
+                        help="How long to use the catalog snapshot before "
+                             "fetching the feeds again.",
+                        required=False)
+
+    parser.add_argument("--verify",
+                        type=str,
+                        dest="verify_dir",
+                        metavar="dir",
+                        help="Check every file in an IPSW folder against "
+                             "its recorded digest.",
+                        required=False)
+
+    parser.add_argument("--verify-algorithm",
+                        dest="verify_algorithm",
+                        choices=["sha1", "sha256"],
+                        default="sha1",
+                        help="Digest used by --verify.",
+                        required=False)
+
     parser.add_argument("--version",
                         action="store_true",
                         dest="ver",
                         help="Version info.",
                         required=False)
 
+    parser.add_argument("--workers",
+                        type=int,
+                        dest="workers",
+                        default=4,
+                        metavar="count",
+                        help="Most downloads, or files checked by --verify, "
+                             "to run at once.",
+                        required=False)
+
     args = parser.parse_args()
 
     # While argsparse is pretty cool, it does have limits when it comes to
@@ -176,6 +275,12 @@ def main():
             precache.print_version()
             sys.exit(0)
 
+        if args.verify_dir:
+            failed = precache.verify_store(args.verify_dir,
+                                           algorithm=args.verify_algorithm,
+                                           workers=args.workers)
+            sys.exit(1 if failed else 0)
+
         if args.list_models and (args.model or args.ipsw_model or args.ver or
                                  args.cache_group or args.cache_ipsw_group or
                                  (args.jamfserver and args.jamfuser and
@@ -201,10 +306,36 @@ def main():
             if args.cache_server:
                 cache_srv = args.cache_server[0]
                 p = precache.PreCache(
-                    cache_server=cache_srv, log_level=level, dry_run=dry)
+                    cache_server=cache_srv, log_level=level, dry_run=dry,
+                    cache_dir=args.cache_dir,
+                    negative_ttl=args.negative_ttl, lazy=True,
+                    snapshot_ttl=args.snapshot_ttl, offline=args.offline,
+                    download_workers=args.workers, per_host=args.per_host,
+                    proxy=args.proxy, chunk_size=args.chunk_size,
+                    segments=args.segments)
             else:
                 p = precache.PreCache(
-                    cache_server=None, log_level=level, dry_run=dry)
+                    cache_server=None, log_level=level, dry_run=dry,
+                    cache_dir=args.cache_dir,
+                    negative_ttl=args.negative_ttl, lazy=True,
+                    snapshot_ttl=args.snapshot_ttl, offline=args.offline,
+                    download_workers=args.workers, per_host=args.per_host,
+                    proxy=args.proxy, chunk_size=args.chunk_size,
+                    segments=args.segments)
+
+            if args.fleet_builds == "jamf":
+                if not (args.jamfserver and args.jamfuser and
+                        args.jamfpassword):
+                    print("--fleet-builds jamf needs --jamfserver, "
+                          "--jamfuser and --jamfpassword")
+                    sys.exit(1)
+            elif args.fleet_builds:
+                from precache.prelib import fleet
+                try:
+                    p.fleet_builds = fleet.load_builds(args.fleet_builds)
+                except IOError as e:
+                    print("Unable to read fleet builds: {}".format(e))
+                    sys.exit(1)
 
             if args.list_models:
                 if args.filter_group:
@@ -213,13 +344,30 @@ def main():
                     p.list_assets()
 
             if args.jamfserver and args.jamfuser and args.jamfpassword:
-                from precache import jamf
-                models = jamf.JamfRequest(args.jamfserver).mobile_ids(
-                    args.jamfuser, args.jamfpassword)
+                from precache.prelib import jamf
+                jamf_builds = args.fleet_builds == "jamf"
+                inventory = jamf.JamfInventory(
+                    jamf.JamfRequest(args.jamfserver),
+                    os.path.join(p.cache_dir, "jamf",
+                                 "{}.json".format(args.jamfserver)),
+                    with_builds=jamf_builds)
+                models = inventory.models(args.jamfuser, args.jamfpassword)
+                if jamf_builds:
+                    p.fleet_builds = inventory.os_builds()
                 if models:
-                    p.cache_assets(model=models)
+                    # Assets for the most common models are fetched first
+                    p.model_weights = models
+                    p.cache_assets(model=sorted(models))
                 else:
-                    logger.error("Empty models list from jamf")
+                    print("Empty models list from jamf")
+                # Models the background refresh found that the saved copy
+                # did not have
+                new_models = inventory.wait()
+                if new_models:
+                    p.model_weights = inventory.counts()
+                    if jamf_builds:
+                        p.fleet_builds = inventory.os_builds()
+                    p.cache_assets(model=new_models)
 
             if args.model:
                 p.cache_assets(model=args.model)